@@ -18,12 +18,26 @@ class GeneDocBackendBase:
         '''update only, no upsert.'''
         raise NotImplemented
 
+    def update_bulk(self, doc_li, ordered=False):
+        '''doc_li is a list of (id, extra_doc) tuples.
+           Backends supporting bulk operations should override it,
+           by default, it falls back to one update per doc.
+        '''
+        for id, extra_doc in doc_li:
+            self.update(id, extra_doc)
+
     def drop(self):
         raise NotImplemented
 
     def get_id_list(self):
         raise NotImplemented
 
+    def get_id_iter(self):
+        '''return an iterator of all ids in ascending order.
+           Backends can override it to stream ids without loading all of them.
+        '''
+        return iter(sorted(self.get_id_list()))
+
     def get_from_id(self, id):
         raise NotImplemented
 
@@ -102,6 +116,21 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
                                       manipulate=False, check_keys=False,
                                       upsert=False, w=0)
 
+    def update_bulk(self, doc_li, ordered=False):
+        '''doc_li is a list of (id, extra_doc) tuples, sent to the server
+           as one ordered or unordered bulk operation.
+           Like "update", non-existing ids are ignored (no upsert).
+        '''
+        if not doc_li:
+            return
+        if ordered:
+            bulk = self.target_collection.initialize_ordered_bulk_op()
+        else:
+            bulk = self.target_collection.initialize_unordered_bulk_op()
+        for id, extra_doc in doc_li:
+            bulk.find({'_id': id}).update_one({'$set': extra_doc})
+        return bulk.execute()
+
     def update_diff(self, diff, extra={}):
         '''update a doc based on the diff returned from diff.diff_doc
             "extra" can be passed (as a dictionary) to add common fields to the
@@ -125,6 +154,17 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
     def get_id_list(self):
         return [x['_id'] for x in self.target_collection.find(fields=[], manipulate=False)]
 
+    def get_id_iter(self, step=100000):
+        '''return an iterator of all ids in ascending order, streamed from "_id" index.'''
+        cur = self.target_collection.find(fields=[], manipulate=False, timeout=False)
+        cur.sort([('_id', 1)])
+        cur.batch_size(step)
+        try:
+            for doc in cur:
+                yield doc['_id']
+        finally:
+            cur.close()
+
     def get_from_id(self, id):
         return self.target_collection.get_from_id(id)
 
@@ -199,6 +239,9 @@ class GeneDocESBackend(GeneDocBackendBase):
 
     def finalize(self):
         conn = self.target_esidxer.conn
+        bulk_writer = self.target_esidxer.bulk_writer
+        bulk_writer.close()
+        bulk_writer.report_failures()
         conn.indices.flush()
         conn.indices.refresh()
         self.target_esidxer.optimize()
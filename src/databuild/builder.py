@@ -5,12 +5,14 @@ import copy
 from datetime import datetime
 from pprint import pprint
 from utils.mongo import (get_src_db, get_target_db, get_src_master,
-                         get_src_build, get_src_dump, doc_feeder)
+                         get_src_build, get_src_dump, doc_feeder,
+                         get_conn, get_id_boundaries, id_range_queries)
 from utils.common import (loadobj, timesofar, safewfile, LogPrint, ask,
                           dump2gridfs, get_timestamp, get_random_string)
-from utils.dataload import list2dict, alwayslist
+from utils.dataload import alwayslist
 from utils.es import ESIndexer
 import databuild.backend
+from databuild.idmapping import IdMapping
 from config import LOG_FOLDER
 
 '''
@@ -57,6 +59,18 @@ class DataBuilder():
         self.src = get_src_db()
         self.step = 10000
         self.use_parallel = False
+        self.use_bulk_update = False  # send merged docs to target in bulk operations.
+        self.bulk_size = 1000         # no. of updates in one bulk operation.
+        self.bulk_ordered = False     # use ordered or unordered bulk operations.
+        self.max_inflight_batches = 2    # max no. of bulk operations executed at the same time.
+        self.merge_processes = None      # no. of worker processes used when use_parallel is True,
+                                         # default is the no. of cpus.
+        self.use_inmemory_merge = False  # merge genedocs in memory, then insert them into target once,
+                                         # only for a build config restricted by "species" (see _merge_inmemory).
+        self.use_sorted_merge = False    # merge genedocs with a sorted k-way merge of all sources.
+        self.merge_tmpdir = None         # folder for temp files used by sorted merge, default is system tmp folder.
+        self.idmapping_folder = None     # if set, idmappings are saved into this folder and memory-mapped.
+        self.prefetch = 2             # no. of batches doc_feeder fetches ahead of the processing.
         self.merge_logging = True     # save output into a logging file when merge is called.
         self.max_build_status = 10    # max no. of records kept in "build" field of src_build collection.
 
@@ -110,6 +124,14 @@ class DataBuilder():
             _cfg['build'][-1].update(dict)
             src_build.update({'_id': self._build_config['_id']}, {"$set": {'build': _cfg['build']}})
 
+    def _get_last_build(self):
+        '''return the last build record from src_build collection, if available.'''
+        src_build = getattr(self, 'src_build', None)
+        if src_build:
+            _cfg = src_build.find_one({'_id': self._build_config['_id']})
+            if _cfg and _cfg.get('build', None):
+                return _cfg['build'][-1]
+
     def log_building_start(self):
         if self.merge_logging:
             #setup logging
@@ -176,10 +198,15 @@ class DataBuilder():
         ensembl2entrez_li = loadobj((u"ensembl_gene__2entrezgene_list.pyobj", self.src), mode='gridfs')
         #filter out those deprecated entrez gene ids
         print len(ensembl2entrez_li)
-        ensembl2entrez_li = [(ensembl_id, self._entrez_geneid_d[int(entrez_id)]) for (ensembl_id, entrez_id) in ensembl2entrez_li
-                             if int(entrez_id) in self._entrez_geneid_d]
-        print len(ensembl2entrez_li)
-        ensembl2entrez = list2dict(ensembl2entrez_li, 0)
+        ensembl2entrez = IdMapping.from_pairs((ensembl_id, self._entrez_geneid_d[int(entrez_id)])
+                                              for (ensembl_id, entrez_id) in ensembl2entrez_li
+                                              if int(entrez_id) in self._entrez_geneid_d)
+        del ensembl2entrez_li
+        print ensembl2entrez.value_count
+        if self.idmapping_folder:
+            idmapping_file = os.path.join(self.idmapping_folder, 'idmapping_ensembl_gene.dat')
+            ensembl2entrez.save(idmapping_file)
+            ensembl2entrez = IdMapping.load(idmapping_file, use_mmap=True)
         self._idmapping_d_cache['ensembl_gene'] = ensembl2entrez
 
     def _save_idmapping_gridfs(self):
@@ -188,11 +215,22 @@ class DataBuilder():
         if self._idmapping_d_cache:
             for id_type in self._idmapping_d_cache:
                 filename = 'tmp_idmapping_d_cache_' + id_type
-                dump2gridfs(self._idmapping_d_cache[id_type], filename, self.src)
+                # saved as a plain gzipped dict, which the loader in ipengines expects.
+                dump2gridfs(self._idmapping_d_cache[id_type].to_dict(), filename, self.src,
+                            compress='gzip')
                 idmapping_gridfs_d[id_type] = filename
         return idmapping_gridfs_d
 
-    def make_genedoc_root(self):
+    def _get_species_query(self):
+        '''return a query to filter root genedocs by "species" or "species_to_exclude".'''
+        if "species" in self._build_config:
+            return {'taxid': {'$in': self._build_config['species']}}
+        elif "species_to_exclude" in self._build_config:
+            return {'taxid': {'$nin': self._build_config['species_to_exclude']}}
+
+    def make_genedoc_root(self, target=None):
+        '''insert root genedocs into <target>, default is self.target.'''
+        target = target or self.target
         if not self._entrez_geneid_d:
             self._load_entrez_geneid_d()
 
@@ -200,19 +238,15 @@ class DataBuilder():
             self._load_ensembl2entrez_li()
             ensembl2entrez = self._idmapping_d_cache['ensembl_gene']
 
-        if "species" in self._build_config:
-            _query = {'taxid': {'$in': self._build_config['species']}}
-        elif "species_to_exclude" in self._build_config:
-            _query = {'taxid': {'$nin': self._build_config['species_to_exclude']}}
-        else:
-            _query = None
+        _query = self._get_species_query()
 
         geneid_set = []
         species_set = set()
         if "entrez_gene" in self._build_config['gene_root']:
-            for doc_li in doc_feeder(self.src['entrez_gene'], inbatch=True,  step=self.step, query=_query):
+            for doc_li in doc_feeder(self.src['entrez_gene'], inbatch=True,  step=self.step, query=_query,
+                                     prefetch=self.prefetch):
                 #target_collection.insert(doc_li, manipulate=False, check_keys=False)
-                self.target.insert(doc_li)
+                target.insert(doc_li)
                 geneid_set.extend([doc['_id'] for doc in doc_li])
                 species_set |= set([doc['taxid'] for doc in doc_li])
             cnt_total_entrez_genes = len(geneid_set)
@@ -223,7 +257,8 @@ class DataBuilder():
         if "ensembl_gene" in self._build_config['gene_root']:
             cnt_ensembl_only_genes = 0
             cnt_total_ensembl_genes = 0
-            for doc_li in doc_feeder(self.src['ensembl_gene'], inbatch=True, step=self.step, query=_query):
+            for doc_li in doc_feeder(self.src['ensembl_gene'], inbatch=True, step=self.step, query=_query,
+                                     prefetch=self.prefetch):
                 _doc_li = []
                 for _doc in doc_li:
                     cnt_total_ensembl_genes += 1
@@ -236,7 +271,7 @@ class DataBuilder():
                         geneid_set.append(_doc['_id'])
                 if _doc_li:
                     #target_collection.insert(_doc_li, manipulate=False, check_keys=False)
-                    self.target.insert(_doc_li)
+                    target.insert(_doc_li)
             cnt_matching_ensembl_genes = cnt_total_ensembl_genes - cnt_ensembl_only_genes
             print '# of ensembl Gene IDs in total: %d' % cnt_total_ensembl_genes
             print '# of ensembl Gene IDs match entrez Gene IDs: %d' % cnt_matching_ensembl_genes
@@ -270,6 +305,13 @@ class DataBuilder():
         try:
             if self.using_ipython_cluster:
                 self._merge_ipython_cluster(step=step)
+            elif self.use_inmemory_merge and 'species' not in self._build_config:
+                print '"species" is not restricted in the build config, using sorted merge instead of in-memory merge.'
+                self._merge_sorted(step=step)
+            elif self.use_inmemory_merge:
+                self._merge_inmemory(step=step)
+            elif self.use_sorted_merge:
+                self._merge_sorted(step=step)
             else:
                 self._merge_local(step=step, restart_at=restart_at)
 
@@ -303,6 +345,8 @@ class DataBuilder():
         '''
         from pprint import pprint
         assert not self.using_ipython_cluster, "Abort. Can only resume merging in non-parallel mode."
+        assert not (self.use_inmemory_merge or self.use_sorted_merge), \
+            "Abort. Cannot resume merging in in-memory or sorted merging mode."
         self.load_build_config(build_config)
         last_build = self._build_config['build'][-1]
         print "Last build record:"
@@ -336,6 +380,211 @@ class DataBuilder():
             self.log_src_build({'status': 'success',
                                 'timestamp': datetime.now()})
 
+    def get_src_changes(self, since):
+        '''return {collection: set of changed _ids} of source collections (including
+           gene_root ones) changed after <since>, from change sets recorded by
+           delta uploads (see dataload.mark_upload_changes).
+           Return None if changes of any collection are not tracked since then,
+           e.g. it was fully uploaded after <since>.
+        '''
+        src_dump = get_src_dump(self.src.connection)
+        upload_jobs = {}
+        for src in src_dump.find():
+            upload_jobs.update(src.get('upload', {}).get('jobs', {}))
+        collection_list = self._build_config['sources'] + \
+            [collection for collection in self._build_config['gene_root']
+             if collection not in self._build_config['sources']]
+        src_changes = {}
+        for collection in collection_list:
+            job = upload_jobs.get(collection, {})
+            changes_since = job.get('changes_since', None)
+            if changes_since is None or changes_since > since:
+                print 'Changes of "{}" are not tracked since {}.'.format(collection, since)
+                return None
+            changed_ids = set()
+            for change in job.get('changes', []):
+                if change['timestamp'] > since:
+                    changed_ids |= loadobj((change['file'], self.src), mode='gridfs')
+            src_changes[collection] = changed_ids
+        return src_changes
+
+    def get_root_ids(self):
+        '''return the set of root gene ids, same as ids of root genedocs from
+           make_genedoc_root, but only "_id" fields are fetched. Build stats are
+           also set to self._stats.
+        '''
+        _query = self._get_species_query()
+        gene_root = self._build_config['gene_root']
+        root_ids = set()
+        species_set = set()
+        _stats = {'total_entrez_genes': 0,
+                  'total_ensembl_genes': 0,
+                  'total_ensembl_only_genes': 0}
+        if 'entrez_gene' in gene_root:
+            for doc in doc_feeder(self.src['entrez_gene'], step=self.step, query=_query,
+                                  fields=['taxid'], prefetch=self.prefetch):
+                root_ids.add(doc['_id'])
+                species_set.add(doc['taxid'])
+            _stats['total_entrez_genes'] = len(root_ids)
+        if 'ensembl_gene' in gene_root:
+            if not self._entrez_geneid_d:
+                self._load_entrez_geneid_d()
+            ensembl2entrez = self.get_idmapping_d('ensembl_gene')
+            for doc in doc_feeder(self.src['ensembl_gene'], step=self.step, query=_query,
+                                  fields=[], prefetch=self.prefetch):
+                _stats['total_ensembl_genes'] += 1
+                if ensembl2entrez.get(doc['_id'], None) is None:
+                    #this is an Ensembl only gene
+                    _stats['total_ensembl_only_genes'] += 1
+                    root_ids.add(doc['_id'])
+        _stats['total_species'] = len(species_set)
+        _stats['total_ensembl_genes_mapped_to_entrez'] = _stats['total_ensembl_genes'] - _stats['total_ensembl_only_genes']
+        _stats['total_genes'] = len(root_ids)
+        self._stats = _stats
+        return root_ids
+
+    def _merge_genedocs_from_ids(self, id_li):
+        '''return merged genedocs of a list of root gene ids, same as the
+           ones from a full merge.
+        '''
+        # sources could have integer "_id", which is converted to a string when merged.
+        query = {'_id': {'$in': list(id_li) + [int(_id) for _id in id_li if _id.isdigit()]}}
+        genedoc_d = {}
+        for collection in ['ensembl_gene', 'entrez_gene']:
+            if collection in self._build_config['gene_root']:
+                for doc in self.src[collection].find({'_id': {'$in': id_li}}):
+                    genedoc_d[doc['_id']] = doc
+        for collection in self._build_config['sources']:
+            if collection in ['entrez_gene', 'ensembl_gene']:
+                continue
+            for doc in self.src[collection].find(query):
+                _doc = genedoc_d.get(str(doc['_id']), None)
+                if _doc is not None:
+                    doc.pop('_id', None)
+                    doc.pop('taxid', None)
+                    _doc.update(doc)
+        return [genedoc_d[_id] for _id in id_li if _id in genedoc_d]
+
+    def merge_incremental(self, build_config, step=10000):
+        '''Merge only genedocs affected by source changes since the last
+           successful build, and apply them to "genedoc_<name>_current" collection,
+           which should be up-to-date with the last build (see databuild.sync).
+           Affected genedocs are root genes added since then, and root genes
+           with changed _ids in any source (see get_src_changes).
+           New and updated genedocs are merged into a staging collection
+           "genedoc_<name>_<%Y%m%d%H%M%S>_incremental" first, which is the "source"
+           of the changes, and is kept (as the collections of full builds), so
+           that the changes can still be applied to ES later (see dataindex.es_sync).
+           The changes are saved (see databuild.sync.save_changes) before they
+           are applied to "genedoc_<name>_current", so that they are not lost
+           if the build fails.
+           Return the changes applied, as the ones from GeneDocSyncer.get_changes,
+           or None if an incremental build is not possible, and a full build
+           (merge) is needed.
+        '''
+        from utils.diff import diff_doc
+        from databuild.sync import GeneDocSyncer, save_changes
+
+        assert self.target.name == 'mongodb', \
+            'Abort. Incremental merging works for "mongodb" backend only.'
+        self.load_build_config(build_config)
+        self.validate_src_collections()
+        target_name = 'genedoc_{}_current'.format(self._build_config['name'])
+        if get_target_db()[target_name].count() == 0:
+            print '"{}" is empty.'.format(target_name)
+            return None
+        last_build = None
+        for build in reversed(self._build_config.get('build', [])):
+            if build.get('status', None) == 'success':
+                last_build = build
+                break
+        if last_build is None:
+            print "No successful build found."
+            return None
+        if GeneDocSyncer('genedoc_' + self._build_config['name']).get_new_source_list():
+            print 'The last build is not applied to "{}" yet.'.format(target_name)
+            return None
+        for collection in self._build_config['sources']:
+            if collection not in ['entrez_gene', 'ensembl_gene'] and \
+               self.src_master[collection].get('id_type', None):
+                print '"{}" needs id conversion, which is not supported by incremental merging.'.format(collection)
+                return None
+        src_changes = self.get_src_changes(since=last_build['started_at'])
+        if src_changes is None:
+            return None
+
+        t0 = time.time()
+        config = 'genedoc_' + self._build_config['name']
+        current = databuild.backend.GeneDocMongoDBBackend(get_target_db()[target_name])
+        _timestamp = datetime.now().replace(microsecond=0)
+        self.prepare_target(target_name='{}_{}_incremental'.format(config, _timestamp.strftime('%Y%m%d%H%M%S')))
+        self.log_building_start()
+        try:
+            self.log_src_build({'incremental': True})
+            self.target.drop()
+            self.target.prepare()
+            root_ids = self.get_root_ids()
+            current_ids = set(current.get_id_list())
+            added = root_ids - current_ids
+            deleted = current_ids - root_ids
+            affected = set(added)
+            for collection in src_changes:
+                affected |= set([str(_id) for _id in src_changes[collection]]) & root_ids
+                print '\t{}: {} changed'.format(collection, len(src_changes[collection]))
+            print "# of genedocs to merge: {} ({} new)".format(len(affected), len(added))
+
+            _updates = []
+            affected = sorted(affected)
+            for i in range(0, len(affected), step):
+                id_li = affected[i:i + step]
+                doc_li = self._merge_genedocs_from_ids(id_li)
+                old_doc_d = dict([(doc['_id'], doc) for doc in current.mget_from_ids(id_li)])
+                new_doc_li = []
+                for doc in doc_li:
+                    old_doc = old_doc_d.get(doc['_id'], None)
+                    if old_doc is not None:
+                        _diff = diff_doc(old_doc, doc)
+                        if not _diff:
+                            continue
+                        _diff['_id'] = doc['_id']
+                        _updates.append(_diff)
+                    new_doc_li.append(doc)
+                if new_doc_li:
+                    self.target.insert(new_doc_li)
+                print "\t{}/{} merged [{}]".format(min(i + step, len(affected)), len(affected), timesofar(t0))
+            self.target.finalize()
+
+            changes = {'update': _updates,
+                       'delete': sorted(deleted),
+                       'add': sorted(added),
+                       'source': self.target.target_name,
+                       'timestamp': _timestamp}
+            print "Done. [{} added, {} updated, {} deleted]".format(
+                len(changes['add']), len(changes['update']), len(changes['delete']))
+            save_changes(changes, config, with_time=True)
+
+            print 'Applying changes to "{}"...'.format(target_name)
+            sc = GeneDocSyncer(config)
+            sc.apply_changes(changes)
+            sc.verify_changes(changes)
+            target_cnt = current.count()
+            if target_cnt != self._stats['total_genes']:
+                print "Warning: total count of gene documents does not match [{}, should be {}]".format(target_cnt, self._stats['total_genes'])
+
+            self._src_version = self.get_src_version()
+            t1 = round(time.time() - t0, 0)
+            self.log_src_build({'status': 'success',
+                                'stats': self._stats,
+                                'src_version': self._src_version,
+                                'changes': dict([(k, len(changes[k])) for k in ['add', 'update', 'delete']]),
+                                'time': timesofar(t0),
+                                'time_in_s': t1,
+                                'timestamp': datetime.now()})
+            return changes
+        finally:
+            if self.merge_logging:
+                sys.stdout.close()
+
     def _merge_ipython_cluster(self, step=100000):
         '''Do the merging on ipython cluster.'''
         from IPython.parallel import Client, require
@@ -364,7 +613,6 @@ class DataBuilder():
         kwargs['src_db'] = self.src.name
         kwargs['target_db'] = target_collection.database.name
         kwargs['target_collection_name'] = target_collection.name
-        kwargs['limit'] = step
 
         @require('mongokit', 'time', 'types')
         def worker(kwargs):
@@ -375,8 +623,7 @@ class DataBuilder():
             target_collection_name = kwargs['target_collection_name']
 
             src_collection = kwargs['src_collection']
-            skip = kwargs['skip']
-            limit = kwargs['limit']
+            query = kwargs['query']
 
             def load_from_gridfs(filename, db):
                 import gzip
@@ -416,7 +663,7 @@ class DataBuilder():
             else:
                 idmapping_d = None
 
-            cur = src[src_collection].find(skip=skip, limit=limit, timeout=False)
+            cur = src[src_collection].find(query, timeout=False)
             cur.batch_size(1000)
             try:
                 for doc in cur:
@@ -442,10 +689,10 @@ class DataBuilder():
             if id_type:
                 idmapping_gridfs_name = idmapping_gridfs_d[id_type]
                 _kwargs['idmapping_gridfs_name'] = idmapping_gridfs_name
-            cnt = self.src[src_collection].count()
-            for s in range(0, cnt, step):
+            boundaries = get_id_boundaries(self.src[src_collection], step=step)
+            for query in id_range_queries(boundaries):
                 __kwargs = copy.copy(_kwargs)
-                __kwargs['skip'] = s
+                __kwargs['query'] = query
                 task_list.append(__kwargs)
 
         print "\t# of tasks: {}".format(len(task_list))
@@ -473,33 +720,158 @@ class DataBuilder():
             geneid_set = set(self.target.get_id_list())
             print '\t', len(geneid_set)
 
-        src_collection_list = self._build_config['sources']
-        src_cnt = 0
-        for collection in src_collection_list:
+        pool = self._start_merge_pool(geneid_set) if self.use_parallel else None
+        try:
+            src_collection_list = self._build_config['sources']
+            src_cnt = 0
+            for collection in src_collection_list:
+                if collection in ['entrez_gene', 'ensembl_gene']:
+                    continue
+
+                src_cnt += 1
+
+                id_type = self.src_master[collection].get('id_type', None)
+                flag_need_id_conversion = id_type is not None
+                if flag_need_id_conversion:
+                    idmapping_d = self.get_idmapping_d(id_type)
+                else:
+                    idmapping_d = None
+
+                if restart_at <= src_cnt:
+                    if self.use_parallel:
+                        self._merge_parallel(collection, pool, step=step, id_type=id_type)
+                    else:
+                        self._merge_sequential(collection, geneid_set,
+                                               step=step, idmapping_d=idmapping_d)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        self.target.finalize()
+
+    def _merge_inmemory(self, step=100000):
+        '''Merge all source collections into genedocs kept in memory first,
+           then insert each fully merged genedoc into the target only once,
+           instead of updating target docs in place for every source.
+           Note that all merged genedocs are in memory until the end, which
+           needs tens of GB for all species (e.g. "mygene_allspecies"), so merge
+           uses it only when "species" is restricted in the build config, and
+           _merge_sorted otherwise.
+        '''
+        self.target.drop()
+        self.target.prepare()
+        genedoc_mem = databuild.backend.GeneDocMemeoryBackend()
+        self.make_genedoc_root(target=genedoc_mem)
+        genedoc_d = genedoc_mem.target_dict
+
+        for collection in self._build_config['sources']:
             if collection in ['entrez_gene', 'ensembl_gene']:
                 continue
+            id_type = self.src_master[collection].get('id_type', None)
+            idmapping_d = self.get_idmapping_d(id_type) if id_type else None
+            for doc in doc_feeder(self.src[collection], step=step, prefetch=self.prefetch):
+                _id = doc['_id']
+                if idmapping_d:
+                    _id = idmapping_d.get(_id, None) or _id
+                for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
+                    __id = str(__id)
+                    _doc = genedoc_d.get(__id, None)
+                    if _doc is not None:
+                        doc.pop('_id', None)
+                        doc.pop('taxid', None)
+                        _doc.update(doc)
+
+        print "Inserting {} merged genedocs...".format(len(genedoc_d)),
+        t0 = time.time()
+        id_li = sorted(genedoc_d)
+        for i in range(0, len(id_li), self.step):
+            # pop out inserted docs to release memory as we go
+            self.target.insert([genedoc_d.pop(_id) for _id in id_li[i:i+self.step]])
+        print "Done.[%s]" % timesofar(t0)
+        self.target.finalize()
+
+    def _merge_sorted(self, step=100000):
+        '''Merge all source collections with a sorted k-way merge (see databuild.merger).
+           All collections are streamed in "_id" order (sources need id conversion
+           are sorted on local disk first), so each merged genedoc is built in one
+           pass and inserted into the target only once.
+        '''
+        from databuild.merger import (is_str_id, sorted_doc_feeder, remapped_doc_feeder,
+                                      spill_sorted, merge_sorted_sources)
+        self.target.drop()
+        self.target.prepare()
+        if not self._entrez_geneid_d:
+            self._load_entrez_geneid_d()
+        _query = self._get_species_query()
+        gene_root = self._build_config['gene_root']
 
-            src_cnt += 1
+        _stats = {'total_entrez_genes': 0,
+                  'total_ensembl_genes': 0,
+                  'total_ensembl_only_genes': 0}
+        species_set = set()
 
+        def _entrez_root():
+            for _id, doc in sorted_doc_feeder(self.src['entrez_gene'], query=_query, step=self.step):
+                _stats['total_entrez_genes'] += 1
+                species_set.add(doc['taxid'])
+                yield _id, doc
+
+        def _ensembl_root(ensembl2entrez):
+            for _id, doc in sorted_doc_feeder(self.src['ensembl_gene'], query=_query, step=self.step):
+                _stats['total_ensembl_genes'] += 1
+                if ensembl2entrez.get(_id, None) is None:
+                    #this is an Ensembl only gene
+                    _stats['total_ensembl_only_genes'] += 1
+                    yield _id, doc
+
+        root_feeders = []
+        if 'entrez_gene' in gene_root:
+            root_feeders.append(_entrez_root())
+        if 'ensembl_gene' in gene_root:
+            root_feeders.append(_ensembl_root(self.get_idmapping_d('ensembl_gene')))
+
+        src_feeders = []
+        for collection in self._build_config['sources']:
+            if collection in ['entrez_gene', 'ensembl_gene']:
+                continue
             id_type = self.src_master[collection].get('id_type', None)
-            flag_need_id_conversion = id_type is not None
-            if flag_need_id_conversion:
-                idmapping_d = self.get_idmapping_d(id_type)
+            if id_type or not is_str_id(self.src[collection]):
+                idmapping_d = self.get_idmapping_d(id_type) if id_type else None
+                doc_iter = doc_feeder(self.src[collection], step=step, prefetch=self.prefetch)
+                src_feeders.append(spill_sorted(remapped_doc_feeder(doc_iter, idmapping_d),
+                                                tmpdir=self.merge_tmpdir))
             else:
-                idmapping_d = None
+                src_feeders.append(sorted_doc_feeder(self.src[collection], step=self.step))
 
-            if restart_at <= src_cnt:
-                if self.use_parallel:
-                    self.doc_queue = []
-                    self._merge_parallel_ipython(collection, geneid_set,
-                                                 step=step, idmapping_d=idmapping_d)
-                else:
-                    self._merge_sequential(collection, geneid_set,
-                                           step=step, idmapping_d=idmapping_d)
+        print "Merging {} root and {} source collections...".format(len(root_feeders), len(src_feeders))
+        t0 = time.time()
+        cnt = 0
+        doc_li = []
+        for doc in merge_sorted_sources(root_feeders, src_feeders):
+            doc_li.append(doc)
+            if len(doc_li) >= self.step:
+                self.target.insert(doc_li)
+                cnt += len(doc_li)
+                doc_li = []
+                print "\t{} merged genedocs inserted.[{}]".format(cnt, timesofar(t0))
+        if doc_li:
+            self.target.insert(doc_li)
+            cnt += len(doc_li)
+        print "Done.[{} merged genedocs, {}]".format(cnt, timesofar(t0))
         self.target.finalize()
 
+        _stats['total_species'] = len(species_set)
+        _stats['total_ensembl_genes_mapped_to_entrez'] = _stats['total_ensembl_genes'] - _stats['total_ensembl_only_genes']
+        _stats['total_genes'] = cnt
+        self._stats = _stats
+        self._src_version = self.get_src_version()
+        self.log_src_build({'stats': _stats, 'src_version': self._src_version})
+
     def _merge_sequential(self, collection, geneid_set, step=100000, idmapping_d=None):
-        for doc in doc_feeder(self.src[collection], step=step):
+        if self.use_bulk_update:
+            return self._merge_sequential_bulk(collection, geneid_set,
+                                               step=step, idmapping_d=idmapping_d)
+        for doc in doc_feeder(self.src[collection], step=step, prefetch=self.prefetch):
             _id = doc['_id']
             if idmapping_d:
                 _id = idmapping_d.get(_id, None) or _id
@@ -513,91 +885,126 @@ class DataBuilder():
                     #                           upsert=False) #,safe=True)
                     self.target.update(__id, doc)
 
-    def _merge_parallel(self, collection, geneid_set, step=100000, idmapping_d=None):
-        from multiprocessing import Process, Queue
-        NUMBER_OF_PROCESSES = 8
-
-        input_queue = Queue()
-        input_queue.conn_pool = []
-
-        def worker(q, target):
-            while True:
-                doc = q.get()
-                if doc == 'STOP':
-                    break
-                __id = doc.pop('_id')
-                doc.pop('taxid', None)
-                target.update(__id, doc)
-                # target_collection.update({'_id': __id}, {'$set': doc},
-                #                           manipulate=False,
-                #                           upsert=False) #,safe=True)
-
-        # Start worker processes
-        for i in range(NUMBER_OF_PROCESSES):
-            Process(target=worker, args=(input_queue, self.target)).start()
-
-        for doc in doc_feeder(self.src[collection], step=step):
-            _id = doc['_id']
-            if idmapping_d:
-                _id = idmapping_d.get(_id, None) or _id
-            for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
-                __id = str(__id)
-                if __id in geneid_set:
-                    doc['_id'] = __id
-                    input_queue.put(doc)
+    def _merge_sequential_bulk(self, collection, geneid_set, step=100000, idmapping_d=None):
+        '''Same as _merge_sequential, but "$set" updates are collected and sent
+           to the target in bulk operations of <self.bulk_size> docs. Up to
+           <self.max_inflight_batches> bulk operations can be executed at the
+           same time, unless <self.bulk_ordered> is True, then bulk operations
+           are executed one at a time to keep the order of updates. Other than
+           "mongodb", backends are not thread-safe (e.g. the shared ESBulkWriter
+           of "es"), so their bulk operations are always executed one at a time.
+        '''
+        from multiprocessing.pool import ThreadPool
 
-        # Tell child processes to stop
-        for i in range(NUMBER_OF_PROCESSES):
-            input_queue.put('STOP')
+        if self.bulk_ordered or self.target.name != 'mongodb':
+            max_inflight = 1
+        else:
+            max_inflight = max(1, self.max_inflight_batches)
+        pool = ThreadPool(max_inflight)
+        pending = []
+        stats = {'batches': 0, 'docs': 0, 'time': 0.}
+
+        def _bulk_update(doc_li):
+            t1 = time.time()
+            self.target.update_bulk(doc_li, ordered=self.bulk_ordered)
+            return len(doc_li), time.time() - t1
+
+        def _collect(job):
+            cnt, t = job.get()    # re-raise any error from the bulk operation
+            stats['batches'] += 1
+            stats['docs'] += cnt
+            stats['time'] += t
+
+        def _flush(doc_li):
+            while pending and (len(pending) >= max_inflight or pending[0].ready()):
+                _collect(pending.pop(0))
+            pending.append(pool.apply_async(_bulk_update, (doc_li,)))
+
+        def _report(cnt, t):
+            print '\t{} bulk operations done [{} docs, {:.1f}s, {} pending]'.format(
+                stats['batches'], stats['docs'], stats['time'], len(pending))
 
-    def _merge_parallel_ipython(self, collection, geneid_set, step=100000, idmapping_d=None):
-        from IPython.parallel import Client, require
+        try:
+            doc_li = []
+            for doc in doc_feeder(self.src[collection], step=step, batch_callback=_report,
+                                  prefetch=self.prefetch):
+                _id = doc['_id']
+                if idmapping_d:
+                    _id = idmapping_d.get(_id, None) or _id
+                for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
+                    __id = str(__id)
+                    if __id in geneid_set:
+                        doc.pop('_id', None)
+                        doc.pop('taxid', None)
+                        doc_li.append((__id, doc))
+                        if len(doc_li) >= self.bulk_size:
+                            _flush(doc_li)
+                            doc_li = []
+            if doc_li:
+                _flush(doc_li)
+            while pending:
+                _collect(pending.pop(0))
+            _report(None, None)
+        finally:
+            pool.terminate()
+            pool.join()
 
-        rc = Client()
-        dview = rc[:]
-        #dview = rc.load_balanced_view()
-        dview.block = False
+    def _start_merge_pool(self, geneid_set):
+        '''start a process pool for _merge_parallel. Everything needed by workers,
+           including geneid_set and idmapping_d, is set to _merge_worker_context
+           before the pool is created, so forked workers inherit it without pickling.
+        '''
+        from multiprocessing import Pool
+        assert self.target.name == 'mongodb', \
+            'Abort. Parallel merging works for "mongodb" backend only.'
+        for collection in self._build_config['sources']:
+            id_type = self.src_master[collection].get('id_type', None)
+            if id_type:
+                self.get_idmapping_d(id_type)
         target_collection = self.target.target_collection
-        dview['server'] = target_collection.database.connection.host
-        dview['port'] = target_collection.database.connection.port
-        dview['database'] = target_collection.database.name
-        dview['collection_name'] = target_collection.name
-
-        def partition(lst, n):
-            q, r = divmod(len(lst), n)
-            indices = [q*i + min(i, r) for i in xrange(n+1)]
-            return [lst[indices[i]:indices[i+1]] for i in xrange(n)]
-
-        @require('mongokit', 'time')
-        def worker(doc_li):
-            conn = mongokit.Connection(server, port)
-            target_collection = conn[database][collection_name]
-            print "len(doc_li): {}".format(len(doc_li))
-            t0 = time.time()
-            for doc in doc_li:
-                __id = doc.pop('_id')
-                doc.pop('taxid', None)
-                target_collection.update({'_id': __id}, {'$set': doc},
-                                         manipulate=False,
-                                         upsert=False)  # ,safe=True)
-            print 'Done. [%.1fs]' % (time.time()-t0)
-
-        for doc in doc_feeder(self.src[collection], step=step):
-            _id = doc['_id']
-            if idmapping_d:
-                _id = idmapping_d.get(_id, None) or _id
-            for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
-                __id = str(__id)
-                if __id in geneid_set:
-                    doc['_id'] = __id
-                    self.doc_queue.append(doc)
+        _merge_worker_context.clear()
+        _merge_worker_context.update({
+            'src_server': self.src.connection.host,
+            'src_port': self.src.connection.port,
+            'src_db': self.src.name,
+            'target_server': target_collection.database.connection.host,
+            'target_port': target_collection.database.connection.port,
+            'target_db': target_collection.database.name,
+            'target_collection': target_collection.name,
+            'geneid_set': geneid_set,
+            'idmapping_d_cache': self._idmapping_d_cache,
+            'bulk_size': self.bulk_size
+        })
+        return Pool(self.merge_processes, initializer=_merge_worker_init)
+
+    def _merge_parallel(self, collection, pool, step=100000, id_type=None):
+        '''merge a source collection using a process pool from _start_merge_pool.
+           The collection is partitioned by "_id" ranges of <step> docs, each
+           partition is merged by a worker with its own connection and bulk updates.
+           Partition boundaries and finished partitions are logged in src_build,
+           so that merge_resume can skip finished partitions.
+        '''
+        last_build = self._get_last_build() or {}
+        boundaries = last_build.get('merge_partitions', {}).get(collection, None)
+        merged_partitions = last_build.get('merged_partitions', {})
+        if boundaries is None:
+            boundaries = get_id_boundaries(self.src[collection], step=step)
+            merge_partitions = last_build.get('merge_partitions', {})
+            merge_partitions[collection] = boundaries
+            self.log_src_build({'merge_partitions': merge_partitions})
+        done_set = set(merged_partitions.get(collection, []))
+        task_li = [(collection, i, query, id_type)
+                   for (i, query) in enumerate(id_range_queries(boundaries))
+                   if i not in done_set]
+        print "\t# of partitions: {} ({} done already)".format(len(task_li) + len(done_set), len(done_set))
 
-                    if len(self.doc_queue) >= step:
-                        #dview.scatter('doc_li', self.doc_queue)
-                        #dview.apply_async(worker)
-                        dview.map_async(worker, partition(self.doc_queue, len(rc.ids)))
-                        self.doc_queue = []
-                        print "!",
+        t0 = time.time()
+        for (_collection, i, cnt) in pool.imap_unordered(_merge_worker, task_li):
+            done_set.add(i)
+            merged_partitions[collection] = sorted(done_set)
+            self.log_src_build({'merged_partitions': merged_partitions})
+            print "\tpartition {} done [{} docs updated, {}/{}, {}]".format(
+                i, cnt, len(done_set), len(boundaries) + 1, timesofar(t0))
 
     def get_src_version(self):
         src_dump = get_src_dump(self.src.connection)
@@ -736,9 +1143,9 @@ class DataBuilder():
                 #     print "skipped."
                 #     continue
                 cnt = self.src[src].count()
-                fdr1 = doc_feeder(self.src[src], step=10000, s=cnt-n)
+                fdr1 = doc_feeder(self.src[src], step=10000, s=cnt-n, prefetch=self.prefetch)
                 rand_s = random.randint(0, cnt-n)
-                fdr2 = doc_feeder(self.src[src], step=n, s=rand_s, e=rand_s+n)
+                fdr2 = doc_feeder(self.src[src], step=n, s=rand_s, e=rand_s+n, prefetch=self.prefetch)
                 _first_exception = True
                 for doc in itertools.chain(fdr1, fdr2):
                     _id = doc['_id']
@@ -848,15 +1255,78 @@ class DataBuilder():
         return changes
 
 
+# shared by worker processes of DataBuilder._merge_parallel, it's set before
+# the process pool is created, so that it's inherited by forked workers.
+_merge_worker_context = {}
+
+
+def _merge_worker_init():
+    '''open new connections in each worker process.'''
+    ctx = _merge_worker_context
+    src_conn = get_conn(ctx['src_server'], ctx['src_port'])
+    target_conn = get_conn(ctx['target_server'], ctx['target_port'])
+    ctx['src'] = src_conn[ctx['src_db']]
+    target_collection = target_conn[ctx['target_db']][ctx['target_collection']]
+    ctx['target'] = databuild.backend.GeneDocMongoDBBackend(target_collection)
+
+
+def _merge_worker(args):
+    '''merge docs within an "_id" range of a source collection into the target.'''
+    collection, task_idx, query, id_type = args
+    ctx = _merge_worker_context
+    try:
+        geneid_set = ctx['geneid_set']
+        idmapping_d = ctx['idmapping_d_cache'][id_type] if id_type else None
+        target = ctx['target']
+        cnt = 0
+        doc_li = []
+        cur = ctx['src'][collection].find(query, timeout=False)
+        cur.batch_size(ctx['bulk_size'])
+        try:
+            for doc in cur:
+                _id = doc['_id']
+                if idmapping_d:
+                    _id = idmapping_d.get(_id, None) or _id
+                for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
+                    __id = str(__id)
+                    if __id in geneid_set:
+                        doc.pop('_id', None)
+                        doc.pop('taxid', None)
+                        doc_li.append((__id, doc))
+                        if len(doc_li) >= ctx['bulk_size']:
+                            target.update_bulk(doc_li)
+                            cnt += len(doc_li)
+                            doc_li = []
+            if doc_li:
+                target.update_bulk(doc_li)
+                cnt += len(doc_li)
+        finally:
+            cur.close()
+        return collection, task_idx, cnt
+    except Exception:
+        # pass the full traceback to the main process
+        import traceback
+        raise RuntimeError('Merging partition {} of "{}" failed:\n{}'.format(
+                           task_idx, collection, traceback.format_exc()))
+
+
 def main():
     if len(sys.argv) > 1:
         config = sys.argv[1]
     else:
         config = 'mygene_allspecies'
     use_parallel = '-p' in sys.argv
+    incremental = '-i' in sys.argv
 
     t0 = time.time()
     bdr = DataBuilder(backend='mongodb')
+    if incremental:
+        # merge only changed genedocs into "genedoc_<config>_current" if possible.
+        changes = bdr.merge_incremental(config)
+        if changes is not None:
+            print "Finished.", timesofar(t0)
+            return
+        print "Falling back to a full build."
     bdr.load_build_config(config)
     bdr.using_ipython_cluster = use_parallel
     bdr.merge()
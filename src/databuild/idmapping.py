@@ -0,0 +1,170 @@
+'''
+A compact read-only id mapping, e.g. from Ensembl gene ids to Entrez gene ids.
+
+All keys and values are packed into a single string buffer:
+
+    header:          magic, no. of keys, no. of values
+    key offsets:     (no. of keys + 1) int64, offsets of keys in the key blob
+    value offsets:   (no. of keys + 1) int64, offsets of values for each key
+    values:          int64 values, values of the same key are contiguous
+    key blob:        sorted keys (utf-8 encoded), concatenated
+
+Keys are looked up with a binary search, first in a small in-memory index of
+every INDEX_STEP-th key, and then within one block of the buffer. As the
+buffer is a single string object, it is shared by forked worker processes
+without being copied, or it can be memory-mapped from a file saved by
+IdMapping.save.
+'''
+import struct
+import mmap
+from bisect import bisect_right
+from itertools import groupby
+from operator import itemgetter
+
+MAGIC = 'IDMAP001'
+_header = struct.Struct('<8sqq')
+_int64 = struct.Struct('<q')
+_int64_pair = struct.Struct('<qq')
+INDEX_STEP = 32
+
+
+def _encode_key(key):
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
+
+
+class IdMapping(object):
+    '''A dict-like mapping of string keys to one or more integer values.
+       Same as list2dict(pairs, 0), the value of a key is a single integer,
+       or a list of integers (in the input order) if the key has more than
+       one value.
+    '''
+    def __init__(self, buf):
+        magic, self._n, self._m = _header.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError('Invalid IdMapping data.')
+        self._buf = buf
+        self._key_offsets_base = _header.size
+        self._value_offsets_base = self._key_offsets_base + 8 * (self._n + 1)
+        self._values_base = self._value_offsets_base + 8 * (self._n + 1)
+        self._keys_base = self._values_base + 8 * self._m
+        self._index = [self._get_key(i) for i in xrange(0, self._n, INDEX_STEP)]
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        '''build an IdMapping from an iterable of (key, int_value) pairs.'''
+        pairs = sorted([(_encode_key(key), value) for key, value in pairs], key=itemgetter(0))
+        key_offsets = [0]
+        value_offsets = [0]
+        values = []
+        keys = []
+        for key, group in groupby(pairs, key=itemgetter(0)):
+            keys.append(key)
+            key_offsets.append(key_offsets[-1] + len(key))
+            values.extend([value for key, value in group])
+            value_offsets.append(len(values))
+        del pairs
+        n, m = len(keys), len(values)
+        return cls(''.join([_header.pack(MAGIC, n, m),
+                            struct.pack('<%dq' % (n + 1), *key_offsets),
+                            struct.pack('<%dq' % (n + 1), *value_offsets),
+                            struct.pack('<%dq' % m, *values),
+                            ''.join(keys)]))
+
+    @classmethod
+    def load(cls, filename, use_mmap=True):
+        '''load an IdMapping saved by save method. If use_mmap is True, the
+           file is memory-mapped instead of being read into memory.
+        '''
+        with open(filename, 'rb') as in_f:
+            if use_mmap:
+                buf = mmap.mmap(in_f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = in_f.read()
+        return cls(buf)
+
+    def save(self, filename):
+        with open(filename, 'wb') as out_f:
+            out_f.write(self._buf[:])
+
+    def __reduce__(self):
+        # pickled as its buffer, also for a memory-mapped one.
+        return (IdMapping, (self._buf[:],))
+
+    def _key_range(self, i):
+        return _int64_pair.unpack_from(self._buf, self._key_offsets_base + 8 * i)
+
+    def _get_key(self, i):
+        start, end = self._key_range(i)
+        return self._buf[self._keys_base + start:self._keys_base + end]
+
+    def _find(self, key):
+        '''return the index of the key, or -1 if not found.'''
+        if not isinstance(key, basestring):
+            return -1
+        key = _encode_key(key)
+        block = bisect_right(self._index, key) - 1
+        if block < 0:
+            return -1
+        # the key can only be in [lo, hi) of the block starting with self._index[block]
+        lo = block * INDEX_STEP
+        hi = min(lo + INDEX_STEP, self._n)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n and self._get_key(lo) == key:
+            return lo
+        return -1
+
+    def _get_value(self, i):
+        start, end = _int64_pair.unpack_from(self._buf, self._value_offsets_base + 8 * i)
+        if end - start == 1:
+            return _int64.unpack_from(self._buf, self._values_base + 8 * start)[0]
+        else:
+            return list(struct.unpack_from('<%dq' % (end - start), self._buf,
+                                           self._values_base + 8 * start))
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i == -1:
+            return default
+        return self._get_value(i)
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i == -1:
+            raise KeyError(key)
+        return self._get_value(i)
+
+    def __contains__(self, key):
+        return self._find(key) != -1
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for i in xrange(self._n):
+            yield self._get_key(i)
+
+    def iteritems(self):
+        for i in xrange(self._n):
+            yield self._get_key(i), self._get_value(i)
+
+    def keys(self):
+        return list(self)
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    @property
+    def value_count(self):
+        '''total no. of values for all keys.'''
+        return self._m
+
+    @property
+    def nbytes(self):
+        return len(self._buf)
@@ -0,0 +1,139 @@
+'''
+Sorted k-way merge of source collections keyed by "_id".
+
+Every source collection is streamed in ascending "_id" order, and all
+streams are merged with a heap, so a merged genedoc can be built in one
+pass without any random lookup by "_id". Sources need "_id" remapping
+(e.g. Ensembl gene ids to Entrez gene ids) are sorted on the remapped ids
+first, spilling sorted runs to local disk when needed.
+'''
+import heapq
+import tempfile
+import cPickle as pickle
+from itertools import groupby
+from operator import itemgetter
+
+from utils.dataload import alwayslist
+
+
+def is_str_id(collection):
+    '''return True if "_id" of the collection is a string, so that the
+       "_id" order from the database matches the Python string order.
+    '''
+    doc = collection.find_one(fields=[])
+    return doc is None or isinstance(doc['_id'], basestring)
+
+
+def sorted_doc_feeder(collection, query=None, step=10000, fields=None):
+    '''yield (_id, doc) from a collection in ascending "_id" order.'''
+    cur = collection.find(query, timeout=False, fields=fields)
+    cur.sort([('_id', 1)])
+    cur.batch_size(step)
+    last_id = None
+    try:
+        for doc in cur:
+            _id = doc['_id']
+            if last_id is not None and _id < last_id:
+                raise ValueError('"_id" from "{}" is not in ascending order ({} < {}).'.format(
+                                 collection.name, _id, last_id))
+            last_id = _id
+            yield _id, doc
+    finally:
+        cur.close()
+
+
+def remapped_doc_feeder(doc_iter, idmapping_d=None):
+    '''yield (new_id, doc) for each doc, where new_id is from idmapping_d
+       (could be multiple ids for one doc), or doc's own "_id" if not mapped.
+       Note that new_id is always converted to a string.
+    '''
+    for doc in doc_iter:
+        _id = doc['_id']
+        if idmapping_d:
+            _id = idmapping_d.get(_id, None) or _id
+        for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
+            yield str(__id), doc
+
+
+def _dump_run(run, tmpdir=None):
+    '''dump a sorted run into a temp file, return the file handler.'''
+    tmp_f = tempfile.TemporaryFile(dir=tmpdir)
+    pickler = pickle.Pickler(tmp_f, pickle.HIGHEST_PROTOCOL)
+    for item in run:
+        pickler.dump(item)
+        pickler.clear_memo()
+    tmp_f.seek(0)
+    return tmp_f
+
+
+def _load_run(tmp_f):
+    unpickler = pickle.Unpickler(tmp_f)
+    while 1:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            break
+
+
+def spill_sorted(pair_iter, run_size=500000, tmpdir=None):
+    '''sort (key, doc) pairs by key, keeping the input order for the same key.
+       Sorted runs of <run_size> pairs are dumped into temp files under <tmpdir>,
+       and then merged back. If there is only one run, it is sorted in memory.
+    '''
+    run_files = []
+    run = []
+    try:
+        for seq, (key, doc) in enumerate(pair_iter):
+            run.append((key, seq, doc))
+            if len(run) >= run_size:
+                run.sort(key=itemgetter(0, 1))
+                run_files.append(_dump_run(run, tmpdir))
+                run = []
+        run.sort(key=itemgetter(0, 1))
+        if run_files:
+            if run:
+                run_files.append(_dump_run(run, tmpdir))
+                run = []
+            run_iter = heapq.merge(*[_load_run(tmp_f) for tmp_f in run_files])
+        else:
+            run_iter = iter(run)
+        for key, seq, doc in run_iter:
+            yield key, doc
+    finally:
+        for tmp_f in run_files:
+            tmp_f.close()
+
+
+def _tagged_feeder(feeder, idx):
+    for seq, (key, doc) in enumerate(feeder):
+        yield key, idx, seq, doc
+
+
+def merge_sorted_sources(root_feeders, src_feeders):
+    '''Merge a list of root feeders and a list of source feeders, each one
+       yields (_id, doc) in ascending _id order.
+       A merged doc is yielded for each _id from any of root feeders, with docs
+       from source feeders applied in the order of the list (as "$set" does).
+       Docs from source feeders, which _id does not exist in any of root
+       feeders, are ignored.
+    '''
+    n_root = len(root_feeders)
+    streams = [_tagged_feeder(feeder, idx)
+               for idx, feeder in enumerate(list(root_feeders) + list(src_feeders))]
+    for _id, group in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        merged_doc = None
+        for key, idx, seq, doc in group:
+            if idx < n_root:
+                if merged_doc is None:
+                    merged_doc = doc
+                else:
+                    merged_doc.update(doc)
+            elif merged_doc is None:
+                # not a root id, skip all remaining docs for this _id
+                break
+            else:
+                doc.pop('_id', None)
+                doc.pop('taxid', None)
+                merged_doc.update(doc)
+        if merged_doc is not None:
+            yield merged_doc
@@ -159,7 +159,7 @@ class GeneDocSyncer:
         t0 = time.time()
         file_handler = bz2.BZ2File if compress else file
         with file_handler(outfile, 'w') as out_f:
-            for doc in doc_feeder(self._target_col, step=100000, fields=['_timestamp']):
+            for doc in doc_feeder(self._target_col, step=100000, fields=['_timestamp'], prefetch=2):
                 out_f.write('{}\t{}\n'.format(doc['_id'], doc['_timestamp'].strftime('%Y%m%d')))
         print("Done.", timesofar(t0))
         return outfile
@@ -228,6 +228,25 @@ def get_changes_stats(changes):
         print('\n'.join(["\t{}: {} {}".format(k, len(attrs[k]), ', '.join(sorted(attrs[k]))) for k in attrs]))
 
 
+def save_changes(changes, config, with_time=False):
+    '''dump changes into a file (read by dataindex.es_sync), and save it to S3.
+       The file name has the date of changes['timestamp'], or also the time if
+       with_time is True, so that changes from more than one incremental
+       build on the same day are kept.
+    '''
+    ts = changes['timestamp'].strftime('%Y%m%d%H%M%S' if with_time else '%Y%m%d')
+    if config == 'genedoc_mygene':
+        dumpfile = 'changes_{}.pyobj'.format(ts)
+    else:
+        dumpfile = 'changes_{}_allspecies.pyobj'.format(ts)
+    dump(changes, dumpfile)
+    dumpfile_key = 'genedoc_changes/' + dumpfile
+    print('Saving to S3: "{}"... '.format(dumpfile_key), end='')
+    send_s3_file(dumpfile, dumpfile_key)
+    print('Done.')
+    #os.remove(dumpfile)
+
+
 def diff_two(col_1, col_2, use_parallel=True):
     target = get_target_db()
     b1 = GeneDocMongoDBBackend(target[col_1])
@@ -280,22 +299,12 @@ def main():
         for src in new_src_li:
             t0 = time.time()
             print("Current source collection:", src)
-            ts = _get_timestamp(src, as_str=True)
             print("Calculating changes... ")
             changes = sc.get_changes(src, use_parallel=use_parallel)
             print("Done")
             get_changes_stats(changes)
             if no_confirm or ask("Continue to save changes...") == 'Y':
-                if config == 'genedoc_mygene':
-                    dumpfile = 'changes_{}.pyobj'.format(ts)
-                else:
-                    dumpfile = 'changes_{}_allspecies.pyobj'.format(ts)
-                dump(changes, dumpfile)
-                dumpfile_key = 'genedoc_changes/' + dumpfile
-                print('Saving to S3: "{}"... '.format(dumpfile_key), end='')
-                send_s3_file(dumpfile, dumpfile_key)
-                print('Done.')
-                #os.remove(dumpfile)
+                save_changes(changes, config)
 
             if no_confirm or ask("Continue to apply changes...") == 'Y':
                 sc.apply_changes(changes)
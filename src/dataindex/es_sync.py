@@ -19,8 +19,11 @@ class ESIndexer2(ESIndexer):
     step = 5000
 
     def _split_source_name(self, source):
-        pat = '(\w+)_(\d{8})_\w{8}'
-        mat = re.match(pat, source)
+        # "<prefix>_<%Y%m%d%H%M%S>_incremental" from an incremental build (see DataBuilder.merge_incremental)
+        mat = re.match('(\w+)_(\d{14})_incremental$', source)
+        if not mat:
+            pat = '(\w+)_(\d{8})_\w{8}'
+            mat = re.match(pat, source)
         prefix, timestamp = mat.groups()
         return prefix, timestamp
 
@@ -122,10 +125,8 @@ class ESIndexer2(ESIndexer):
 
     def get_mapping_meta(self, changes):
         src = changes['source']
-        pat = 'genedoc_(\w+)_(\d{8})_\w{8}'
-        mat = re.match(pat, src)
-        if mat:
-            build_cfg, timestamp = mat.groups()
+        build_cfg, timestamp = self._split_source_name(src)
+        build_cfg = build_cfg[len('genedoc_'):]
         src_build = get_src_build()
         _cfg = src_build.find_one({'_id': build_cfg})
         _li = [x for x in _cfg['build'] if x['target'] == src]
@@ -135,9 +136,18 @@ class ESIndexer2(ESIndexer):
         meta = dict(source=src,
                     src_version=_build['src_version'],
                     stats=_build['stats'],
-                    timestamp=_build['timestamp'])
+                    timestamp=_build['timestamp'],
+                    # to find changes files not applied yet (see main)
+                    changes_timestamp=changes['timestamp'].strftime('%Y%m%d%H%M%S'))
         return meta
 
+    def get_index_mapping_meta(self):
+        '''return "_meta" in the mapping of the index (see update_mapping_meta).'''
+        idx_mapping = self.conn.indices.get_mapping(self.ES_INDEX_TYPE, self.ES_INDEX_NAME, raw=True)
+        # keyed by the actual index name, if ES_INDEX_NAME is an alias
+        idx_mapping = idx_mapping.values()[0]
+        return idx_mapping[self.ES_INDEX_TYPE].get('_meta', {})
+
     def post_verify_changes(self, changes):
         target = GeneDocESBackend(self)
         _timestamp = changes['timestamp']
@@ -191,16 +201,21 @@ class ESIndexer2(ESIndexer):
 #esi.post_verify_changes(changes)
 
 
-def _get_current_changes_fn(config):
+def _get_changes_fn_list(config):
+    '''return a list of (<%Y%m%d%H%M%S>, <changes file>) in the current folder
+       (see databuild.sync.save_changes), sorted by the timestamps.
+    '''
     if config == 'genedoc_mygene_allspecies':
-        pattern = 'changes_\d{8}_allspecies.pyobj'
+        pattern = 'changes_(\d{8})(\d{6})?_allspecies\.pyobj$'
     elif config == 'genedoc_mygene':
-        pattern = 'changes_\d{8}.pyobj'
+        pattern = 'changes_(\d{8})(\d{6})?\.pyobj$'
 
-    fli = [f for f in os.listdir('.') if re.match(pattern, f)]
-    if fli:
-        _changes_fn = sorted(fli)[-1]
-        return _changes_fn
+    fli = []
+    for f in os.listdir('.'):
+        mat = re.match(pattern, f)
+        if mat:
+            fli.append((mat.group(1) + (mat.group(2) or '000000'), f))
+    return sorted(fli)
 
 
 def main():
@@ -214,17 +229,10 @@ def main():
     assert config in ['genedoc_mygene', 'genedoc_mygene_allspecies']
     noconfirm = '-b' in sys.argv
 
-    _changes_fn = _get_current_changes_fn(config)
-    if _changes_fn:
-        print("Changes file: " + _changes_fn)
-    else:
+    _changes_fn_li = _get_changes_fn_list(config)
+    if not _changes_fn_li:
         print("No changes file found. Aborted.")
         return -1
-    if noconfirm or ask("Continue to load?") == 'Y':
-        changes = loadobj(_changes_fn)
-    else:
-        print("Aborted.")
-        return -2
 
     _es_host = 'localhost:' + str(es_local_tunnel_port)
     _es_index = config + '_current_1'
@@ -235,12 +243,32 @@ def main():
 
     with open_tunnel():
         esi = ESIndexer2(_es_index, es_host=_es_host)
-        meta = esi.get_mapping_meta(changes)
-        print('\033[34;06m{}\033[0m:'.format('[Metadata]'))
-        pprint(meta)
-        code = esi.apply_changes(changes, noconfirm=noconfirm)
-        if code != -1:
-            # aborted when code == -1
+        # apply all changes files after the last applied one, in order, so
+        # that none is skipped if more than one build is done between syncs.
+        _last_ts = esi.get_index_mapping_meta().get('changes_timestamp', None)
+        if _last_ts:
+            _changes_fn_li = [fn for ts, fn in _changes_fn_li if ts > _last_ts]
+        else:
+            # not recorded by an earlier sync, so apply only the latest one
+            _changes_fn_li = [_changes_fn_li[-1][1]]
+        if not _changes_fn_li:
+            print("No new changes file found. Aborted.")
+            return -1
+        print("Changes files: " + ', '.join(_changes_fn_li))
+        if not (noconfirm or ask("Continue to load?") == 'Y'):
+            print("Aborted.")
+            return -2
+
+        for _changes_fn in _changes_fn_li:
+            print("Changes file: " + _changes_fn)
+            changes = loadobj(_changes_fn)
+            meta = esi.get_mapping_meta(changes)
+            print('\033[34;06m{}\033[0m:'.format('[Metadata]'))
+            pprint(meta)
+            code = esi.apply_changes(changes, noconfirm=noconfirm)
+            if code == -1:
+                # aborted, so do not apply the later ones either
+                return -1
             _meta = {'_meta': meta}
             # somehow when only update "_meta", "_timestamp" get empty
             # so add "_timestamp" explicitly here. This is an ES bug.
@@ -1,14 +1,17 @@
 '''data_load module is for loading individual genedocs from various data sources.'''
 
 import sys
+import os
 import copy
 import types
 import time
 import datetime
 import importlib
-from mongokit import Document, CustomType
-from utils.mongo import get_src_conn, get_src_dump
-from utils.common import get_timestamp, get_random_string, timesofar, dump2gridfs
+import hashlib
+import json
+from mongokit import Document, CustomType, RequireFieldError
+from utils.mongo import get_src_conn, get_src_db, get_src_dump
+from utils.common import get_timestamp, get_random_string, timesofar, dump2gridfs, loadobj, iter_n
 from config import DATA_SRC_DATABASE, DATA_SRC_MASTER_COLLECTION
 
 
@@ -43,6 +46,34 @@ __sources_dict__ = {
     'ucsc':     ['ucsc.ucsc_exons']
     }
 
+# when uploaded in parallel (see load_all), a source starts after the sources
+# it depends on are uploaded successfully, if they are uploaded together.
+__sources_dependencies__ = {
+    'entrez.entrez_homologene': ['entrez.entrez_gene'],    # share geneid_d cache
+    'entrez.entrez_unigene': ['entrez.entrez_gene'],
+}
+
+# sources uploaded one after another in the same worker process, to share
+# data parsed in memory (e.g. the uniprot idmapping scan, or the Ensembl
+# tables, see ensembl_base.get_shared_table).
+__sources_same_process__ = [
+    ['uniprot', 'uniprot.uniprot_pdb', 'uniprot.uniprot_ipi', 'uniprot.uniprot_pir'],
+    ['ensembl.ensembl_gene', 'ensembl.ensembl_acc', 'ensembl.ensembl_genomic_pos',
+     'ensembl.ensembl_prosite', 'ensembl.ensembl_interpro'],
+]
+
+# estimated peak memory (in GB) of uploading a source, used for the memory
+# budget in load_all. DEFAULT_UPLOAD_MEMORY is used for others.
+__sources_memory__ = {
+    'entrez.entrez_go': 8,
+    'entrez.entrez_homologene': 4,
+    'uniprot': 16,
+}
+DEFAULT_UPLOAD_MEMORY = 4
+
+# max. no. of change sets from delta uploads kept for each source (see mark_upload_changes).
+DELTA_CHANGES_KEPT = 20
+
 __sources__ = None   # should be a list defined at runtime
 
 conn = get_src_conn()
@@ -55,6 +86,14 @@ def get_data_folder(src_name):
     return src_doc['data_folder']
 
 
+def get_doc_hash(doc):
+    '''return a content hash of a genedoc, which is the same for a doc parsed
+       from data files and the one stored in MongoDB (e.g. str vs. unicode,
+       tuple vs. list).
+    '''
+    return hashlib.sha1(json.dumps(doc, sort_keys=True, default=unicode)).digest()[:8]
+
+
 class CustomField(CustomType):
     pass
 
@@ -80,6 +119,8 @@ class GeneDocSource(Document):
     DEFAULT_FIELDTYPE = unicode
 
     temp_collection = None     # temp collection is for dataloading
+    validate_sample_size = 1000   # with validate="sample", the first <validate_sample_size> docs
+    validate_sample_step = 1000   # and then one in every <validate_sample_step> docs are validated.
 
     def make_temp_collection(self):
         '''Create a temp collection for dataloading, e.g., entrez_geneinfo_INEMO.'''
@@ -92,48 +133,105 @@ class GeneDocSource(Document):
         self.temp_collection = self.db[new_collection]
         return new_collection
 
+    def _get_doc_checker(self):
+        '''return a function for quick checks on a plain genedoc, which is
+           compiled from top-level required_fields.
+        '''
+        required_fields = [field for field in (self.required_fields or []) if '.' not in field]
+
+        def _check(doc):
+            for field in required_fields:
+                if doc.get(field, None) is None:
+                    raise RequireFieldError('%s is required (doc "%s")' % (field, doc['_id']))
+        return _check
+
     def doc_iterator(self, genedoc_d, batch=True, step=10000, validate=True):
+        '''genedoc_d can be a dictionary of genedocs, or an iterator of (_id, doc) pairs.
+           validate can be:
+              True:     validate each doc by mongokit, docs are yielded as mongokit documents.
+              "sample": docs are yielded as plain dictionaries, and only checked for
+                        required fields, except a sample of docs are validated by mongokit
+                        (see validate_sample_size and validate_sample_step).
+              False:    no validation, docs are yielded as plain dictionaries.
+        '''
         if batch:
             doc_li = []
-            i = 0
-        for _id, doc in genedoc_d.items():
-            doc['_id'] = _id
+        if hasattr(genedoc_d, 'iteritems'):
+            genedoc_d = genedoc_d.iteritems()
+        if validate == 'sample':
+            check_doc = self._get_doc_checker()
             _doc = copy.copy(self)
-            _doc.clear()
-            _doc.update(doc)
-            if validate:
+        for i, (_id, doc) in enumerate(genedoc_d):
+            doc['_id'] = _id
+            if validate == 'sample':
+                check_doc(doc)
+                if i < self.validate_sample_size or i % self.validate_sample_step == 0:
+                    _doc.clear()
+                    _doc.update(doc)
+                    _doc.validate()
+            elif validate:
+                _doc = copy.copy(self)
+                _doc.clear()
+                _doc.update(doc)
                 _doc.validate()
+                doc = _doc
             if batch:
-                doc_li.append(_doc)
-                i += 1
-                if i % step == 0:
+                doc_li.append(doc)
+                if len(doc_li) >= step:
                     yield doc_li
                     doc_li = []
             else:
-                yield _doc
+                yield doc
 
-        if batch:
+        if batch and doc_li:
             yield doc_li
 
-    def load(self, genedoc_d=None, update_data=True, update_master=True, test=False, step=10000):
-        if not self.temp_collection:
-            self.make_temp_collection()
-
-        self.temp_collection.drop()       # drop all existing records just in case.
-
+    def get_genedoc_iter(self):
+        '''return an iterator of (_id, doc) pairs from load_genedoc_iter if the
+           source supports it, so that genedocs are streamed without loading
+           all of them in memory. Otherwise, return the dictionary from load_genedoc.
+        '''
+        if hasattr(self, 'load_genedoc_iter'):
+            return self.load_genedoc_iter()
+        else:
+            return self.load_genedoc()
+
+    def load(self, genedoc_d=None, update_data=True, update_master=True, test=False, step=10000,
+             validate='sample', delta=False):
+        '''upload genedocs into a temp collection, and then switch it to the
+           source collection. See doc_iterator for "validate" parameter, and
+           use validate_all for a full validation.
+           With delta=True, only added, updated or deleted docs are applied to
+           the source collection (see load_delta), if it was uploaded with
+           delta=True before. Otherwise, it is a full upload, which saves the
+           doc hashes for the next delta upload.
+        '''
         if update_data:
-            genedoc_d = genedoc_d or self.load_genedoc()
-
-            print "Uploading to the DB...",
-            t0 = time.time()
-            # for doc in self.doc_iterator(genedoc_d, batch=False):
-            #     if not test:
-            #         doc.save()
-            for doc_li in self.doc_iterator(genedoc_d, batch=True, step=step):
+            genedoc_d = genedoc_d or self.get_genedoc_iter()
+            doc_hashes = self.get_doc_hashes() if delta else None
+            if doc_hashes is not None:
+                self.load_delta(genedoc_d, doc_hashes, test=test, step=step, validate=validate)
+            else:
+                if delta:
+                    print "No doc hashes from the last upload, uploading all docs."
+                if not self.temp_collection:
+                    self.make_temp_collection()
+                self.temp_collection.drop()       # drop all existing records just in case.
+
+                print "Uploading to the DB...",
+                t0 = time.time()
+                doc_hashes = {} if delta else None
+                for doc_li in self.doc_iterator(genedoc_d, batch=True, step=step, validate=validate):
+                    if delta:
+                        for doc in doc_li:
+                            doc_hashes[doc['_id']] = get_doc_hash(doc)
+                    if not test:
+                        self.temp_collection.insert(doc_li, manipulate=False, check_keys=False)
+                print 'Done[%s]' % timesofar(t0)
+                self.switch_collection()
                 if not test:
-                    self.temp_collection.insert(doc_li, manipulate=False, check_keys=False)
-            print 'Done[%s]' % timesofar(t0)
-            self.switch_collection()
+                    self.save_doc_hashes(doc_hashes)
+                    mark_upload_changes(self.src_name)
 
             if getattr(self, 'ENTREZ_GENEDOC_ROOT', False):
                 print 'Uploading "geneid_d" to GridFS...',
@@ -175,9 +273,85 @@ class GeneDocSource(Document):
         else:
             print "Error: load data first."
 
+    @property
+    def doc_hash_file(self):
+        return self.__collection__ + '__dochash.pyobj'
+
+    def get_doc_hashes(self):
+        '''return {_id: doc hash} of all docs in the source collection, saved
+           by the last upload, or None if not available.
+        '''
+        import gridfs
+        fs = gridfs.GridFS(self.db)
+        if self.collection.count() > 0 and fs.exists(_id=self.doc_hash_file):
+            return loadobj((self.doc_hash_file, self.db), mode='gridfs')
+
+    def save_doc_hashes(self, doc_hashes):
+        '''save doc hashes to GridFS, or remove saved ones if doc_hashes is None.'''
+        import gridfs
+        fs = gridfs.GridFS(self.db)
+        if doc_hashes is not None:
+            dump2gridfs(doc_hashes, self.doc_hash_file, self.db)
+        elif fs.exists(_id=self.doc_hash_file):
+            fs.delete(self.doc_hash_file)
+
+    def load_delta(self, genedoc_d, doc_hashes, test=False, step=10000, validate='sample'):
+        '''apply genedocs to the source collection, where doc_hashes is from
+           the last upload (see get_doc_hashes). Only the docs with a changed
+           hash are replaced and new docs are inserted (both as upserts, so a
+           doc is never missing while being replaced), and the docs no longer
+           exist are removed. Changed _ids are recorded in src_dump (see
+           mark_upload_changes). A ValueError is raised on a duplicate _id.
+        '''
+        def _replace(doc_li):
+            if not test:
+                bulk = self.collection.initialize_unordered_bulk_op()
+                for doc in doc_li:
+                    bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+                bulk.execute()
+
+        print "Uploading changes to the DB...",
+        t0 = time.time()
+        new_doc_hashes = {}
+        added = []
+        updated = []
+        doc_li = []
+        for doc in self.doc_iterator(genedoc_d, batch=False, validate=validate):
+            _id = doc['_id']
+            if _id in new_doc_hashes:
+                # an upsert would silently replace the doc with the same _id
+                raise ValueError('Duplicate _id "%s" from "%s".' % (_id, self.src_name))
+            doc_hash = get_doc_hash(doc)
+            new_doc_hashes[_id] = doc_hash
+            old_doc_hash = doc_hashes.get(_id, None)
+            if old_doc_hash == doc_hash:
+                continue
+            if old_doc_hash is None:
+                added.append(_id)
+            else:
+                updated.append(_id)
+            doc_li.append(doc)
+            if len(doc_li) >= step:
+                _replace(doc_li)
+                doc_li = []
+        if doc_li:
+            _replace(doc_li)
+        deleted = [_id for _id in doc_hashes if _id not in new_doc_hashes]
+        if not test:
+            for id_li in iter_n(deleted, step):
+                self.collection.remove({'_id': {'$in': list(id_li)}})
+        print 'Done[%s]' % timesofar(t0)
+        print '\t%d added, %d updated, %d deleted, %d unchanged.' % (
+            len(added), len(updated), len(deleted), len(new_doc_hashes) - len(added) - len(updated))
+
+        if not test and (added or updated or deleted):
+            self.save_doc_hashes(new_doc_hashes)
+            mark_upload_changes(self.src_name, added + updated + deleted,
+                                add=len(added), update=len(updated), delete=len(deleted))
+
     def validate_all(self, genedoc_d=None):
         """validate all genedoc_d."""
-        genedoc_d = genedoc_d or self.load_genedoc()
+        genedoc_d = genedoc_d or self.get_genedoc_iter()
         for doc in self.doc_iterator(genedoc_d, batch=False, validate=True):
             pass
 
@@ -188,7 +362,10 @@ def register_sources():
         metadata = src_m.__metadata__
         name = src + '_doc'
         metadata['load_genedoc'] = src_m.load_genedoc
+        metadata['src_name'] = src
         metadata['get_mapping'] = src_m.get_mapping
+        if hasattr(src_m, 'load_genedoc_iter'):
+            metadata['load_genedoc_iter'] = src_m.load_genedoc_iter
         if metadata.get('ENTREZ_GENEDOC_ROOT', False):
             metadata['get_geneid_d'] = src_m.get_geneid_d
         if metadata.get('ENSEMBL_GENEDOC_ROOT', False):
@@ -214,9 +391,206 @@ def update_mapping(src):
     _src.load(update_data=False, update_master=True)
 
 
-def load_all(**kwargs):
-    for src in __sources__:
+def mark_upload_status(src, status, **extra):
+    '''set upload status of a source (e.g. "entrez.entrez_go") in the src_dump
+       doc of its data source (e.g. "entrez"), as "upload.jobs.<name>".
+    '''
+    src_dump = get_src_dump()
+    prefix = 'upload.jobs.' + src.split('.')[-1]
+    _updates = {prefix + '.status': status,
+                prefix + '.timestamp': datetime.datetime.now()}
+    for k, v in extra.items():
+        _updates[prefix + '.' + k] = v
+    src_dump.update({'_id': src.split('.')[0]}, {'$set': _updates})
+
+
+def get_upload_status(src):
+    '''return the upload status of a source set by mark_upload_status, or None.'''
+    src_doc = get_src_dump().find_one({'_id': src.split('.')[0]}) or {}
+    job = src_doc.get('upload', {}).get('jobs', {}).get(src.split('.')[-1], {})
+    return job.get('status', None)
+
+
+def mark_upload_changes(src, changed_ids=None, **counts):
+    '''record _ids changed by an upload of a source in src_dump, next to its
+       upload status (see mark_upload_status):
+         "upload.jobs.<name>.changes":  a list of change sets from delta uploads, as
+                                        {"timestamp", "file", "add", "update", "delete"},
+                                        where "file" is the GridFS file (in the source db)
+                                        of the set of changed _ids.
+         "upload.jobs.<name>.changes_since": all changes after this time are in the list,
+                                        e.g. the time of the last full upload.
+       changed_ids=None is for a full upload, which resets the list. Only the
+       last DELTA_CHANGES_KEPT change sets are kept.
+    '''
+    import gridfs
+    src_dump = get_src_dump()
+    src_db = get_src_db()
+    fs = gridfs.GridFS(src_db)
+    name = src.split('.')[-1]
+    prefix = 'upload.jobs.' + name
+    src_doc = src_dump.find_one({'_id': src.split('.')[0]}) or {}
+    job = src_doc.get('upload', {}).get('jobs', {}).get(name, {})
+    change_li = job.get('changes', [])
+    changes_since = job.get('changes_since', None)
+    now = datetime.datetime.now()
+    if changed_ids is None:
+        expired_li = change_li
+        change_li = []
+        changes_since = now
+    else:
+        filename = '%s__changes_%s_%s.pyobj' % (name, now.strftime('%Y%m%d%H%M%S'), get_random_string())
+        dump2gridfs(set(changed_ids), filename, src_db)
+        _change = {'timestamp': now, 'file': filename}
+        _change.update(counts)
+        change_li.append(_change)
+        expired_li = change_li[:-DELTA_CHANGES_KEPT]
+        change_li = change_li[-DELTA_CHANGES_KEPT:]
+        if expired_li:
+            changes_since = expired_li[-1]['timestamp']
+    for _change in expired_li:
+        if fs.exists(_id=_change['file']):
+            fs.delete(_change['file'])
+    src_dump.update({'_id': src.split('.')[0]}, {'$set': {prefix + '.changes': change_li,
+                                                         prefix + '.changes_since': changes_since}})
+
+
+def clear_shared_data(src, src_li):
+    '''free data shared in memory by the sources of a data source (e.g. the
+       Ensembl tables, see ensembl_base.get_shared_table), after "src" is
+       uploaded, if none of the sources left in "src_li" is from the same one.
+    '''
+    if src.startswith('ensembl.') and \
+       not [_src for _src in src_li if _src.startswith('ensembl.')]:
+        ensembl_base = importlib.import_module('dataload.sources.ensembl.ensembl_base')
+        ensembl_base.clear_shared_tables()
+
+
+def _upload_worker(src_li, kwargs):
+    '''upload a list of sources one after another in a worker process.
+       If one fails, the rest of them are canceled.
+    '''
+    for i, src in enumerate(src_li):
+        t0 = time.time()
+        mark_upload_status(src, 'uploading', pid=os.getpid())
+        try:
+            load_src(src, **kwargs)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            mark_upload_status(src, 'failed', err=repr(e), time=timesofar(t0))
+            for _src in src_li[i+1:]:
+                print 'Canceled "%s": "%s" failed in the same process.' % (_src, src)
+                mark_upload_status(_src, 'canceled')
+            sys.exit(1)
+        mark_upload_status(src, 'success', time=timesofar(t0))
+        clear_shared_data(src, src_li[i+1:])
+
+
+def _get_upload_jobs(src_li):
+    '''group sources into jobs (lists of sources) based on __sources_same_process__,
+       and return a list of (job, dependent_jobs).
+    '''
+    job_li = []
+    job_of_src = {}
+    for src in src_li:
+        if src in job_of_src:
+            continue
+        job = [src]
+        for group in __sources_same_process__:
+            if src in group:
+                job = [_src for _src in group if _src in src_li]
+        job_li.append(job)
+        for _src in job:
+            job_of_src[_src] = len(job_li) - 1
+
+    out = []
+    for i, job in enumerate(job_li):
+        dep_set = set()
+        for src in job:
+            for dep in __sources_dependencies__.get(src, []):
+                if dep in job_of_src and job_of_src[dep] != i:
+                    dep_set.add(job_of_src[dep])
+        out.append((job, dep_set))
+    return out
+
+
+def load_all_parallel(processes=None, memory_budget=None, **kwargs):
+    '''upload __sources__ in parallel worker processes.
+       Up to <processes> workers (default is the no. of cpus) run at the same
+       time, if the total of their estimated memory (see __sources_memory__)
+       is within <memory_budget> GB (no limit if None), but at least one.
+       Upload status of each source is set in src_dump (see mark_upload_status).
+    '''
+    import multiprocessing
+
+    processes = processes or multiprocessing.cpu_count()
+    jobs = _get_upload_jobs(__sources__)
+    job_memory = [max([__sources_memory__.get(src, DEFAULT_UPLOAD_MEMORY) for src in job])
+                  for job, dep_set in jobs]
+    for job, dep_set in jobs:
+        for src in job:
+            mark_upload_status(src, 'pending')
+
+    t0 = time.time()
+    waiting = range(len(jobs))
+    running = {}
+    done = set()
+    failed = set()
+    while waiting or running:
+        for i in list(waiting):
+            job, dep_set = jobs[i]
+            if dep_set & failed:
+                waiting.remove(i)
+                failed.add(i)
+                for src in job:
+                    print 'Canceled "%s": a source it depends on failed.' % src
+                    mark_upload_status(src, 'canceled')
+            elif dep_set <= done and len(running) < processes:
+                memory_in_use = sum([job_memory[j] for j in running])
+                if running and memory_budget and memory_in_use + job_memory[i] > memory_budget:
+                    continue
+                p = multiprocessing.Process(target=_upload_worker, args=(job, kwargs))
+                p.start()
+                print 'Started %s [pid: %s, %d running]' % (job, p.pid, len(running) + 1)
+                running[i] = p
+                waiting.remove(i)
+
+        time.sleep(1)
+        for i, p in running.items():
+            if not p.is_alive():
+                p.join()
+                del running[i]
+                job = jobs[i][0]
+                if p.exitcode == 0:
+                    done.add(i)
+                    print 'Finished %s [%s]' % (job, timesofar(t0))
+                else:
+                    failed.add(i)
+                    print 'Failed %s with exit code %s [%s]' % (job, p.exitcode, timesofar(t0))
+                    if p.exitcode < 0:
+                        # killed (e.g. out of memory), so the worker could not set the status.
+                        for src in job:
+                            status = get_upload_status(src)
+                            if status == 'uploading':
+                                mark_upload_status(src, 'failed', err='killed by signal %d' % -p.exitcode)
+                            elif status == 'pending':
+                                mark_upload_status(src, 'canceled')
+    print 'Done: %d succeeded, %d failed or canceled [%s]' % (len(done), len(failed), timesofar(t0))
+    return len(failed) == 0
+
+
+def load_all(processes=1, memory_budget=None, **kwargs):
+    '''upload all __sources__, one after another if processes is 1,
+       otherwise in parallel (see load_all_parallel).
+       Return True if all of them are uploaded successfully.
+    '''
+    if processes != 1:
+        return load_all_parallel(processes=processes, memory_budget=memory_budget, **kwargs)
+    for i, src in enumerate(__sources__):
         load_src(src, **kwargs)
+        clear_shared_data(src, __sources__[i+1:])
+    return True
 
 
 def get_mapping():
@@ -242,12 +616,28 @@ def main():
         python -m dataload ensembl.ensembl_gene ensembl.ensembl_acc ensembl.ensembl_genomic_pos ensembl.ensembl_prosite ensembl.ensembl_interpro
         python -m dataload/__init__ entrez.entrez_gene entrez.entrez_homologene entrez.entrez_genesummary entrez.entrez_accession entrez.entrez_refseq entrez.entrez_unigene entrez.entrez_go entrez.entrez_ec entrez.entrez_retired
 
+    with "-p", sources are uploaded in parallel (see load_all_parallel).
+    with "-m <GB>", also in parallel, within the memory budget of <GB> GB.
+    with "-d", only changed docs are uploaded (see GeneDocSource.load_delta).
     '''
 
     global __sources__
-    __sources__ = sys.argv[1:]
+    args = sys.argv[1:]
+    memory_budget = None
+    if '-m' in args:
+        idx = args.index('-m')
+        assert idx + 1 < len(args), 'Missing memory budget (in GB) after "-m".'
+        memory_budget = float(args[idx + 1])
+        del args[idx:idx + 2]
+    __sources__ = [src for src in args if not src.startswith('-')]
     register_sources()
-    load_all()
+    delta = '-d' in args
+    if '-p' in args or memory_budget:
+        success = load_all(processes=None, memory_budget=memory_budget, delta=delta)
+    else:
+        success = load_all(delta=delta)
+    if not success:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -6,7 +6,7 @@ from dataload import get_data_folder
 from utils.common import SubStr
 from utils.dataload import (load_start, load_done,
                             tab2dict, tab2list, value_convert, normalized_value,
-                            list2dict, dict_nodup, dict_attrmerge
+                            list2dict, dict_nodup, dict_attrmerge, parsed_cache
                             )
 
 #DATA_FOLDER = os.path.join(DATA_ARCHIVE_ROOT, 'by_resources/ensembl/69')
@@ -17,10 +17,56 @@ print('DATA_FOLDER: ' + DATA_FOLDER)
 #fn to skip lines with LRG records.'''
 _not_LRG = lambda ld: not ld[1].startswith("LRG_")
 
+ENSEMBL2ENTREZ_DATAFILE = os.path.join(DATA_FOLDER, 'gene_ensembl__xref_entrezgene__dm.txt')
+ENSEMBL_MAIN_DATAFILES = [os.path.join(DATA_FOLDER, 'gene_ensembl__gene__main.txt'),
+                          os.path.join(DATA_FOLDER, 'gene_ensembl__translation__main.txt')]
+
+#parsed tables shared by all EnsemblParser instances in the same process
+#(they are also cached on disk by parsed_cache across processes), which
+#must not be modified.
+_shared_tables = {}
+
+
+@parsed_cache(files=lambda: [ENSEMBL2ENTREZ_DATAFILE], name='ensembl.ensembl2entrez_li')
+def _parse_ensembl2entrez_li():
+    """gene_ensembl__xref_entrezgene__dm"""
+    load_start(ENSEMBL2ENTREZ_DATAFILE)
+    ensembl2entrez_li = tab2list(ENSEMBL2ENTREZ_DATAFILE, (1,2), includefn=_not_LRG)   # [(ensembl_gid, entrez_gid),...]
+    load_done('[%d]' % len(ensembl2entrez_li))
+    return ensembl2entrez_li
+
+
+@parsed_cache(files=lambda: [ENSEMBL2ENTREZ_DATAFILE], name='ensembl.ensembl2entrez_maps')
+def _parse_ensembl2entrez_maps():
+    '''return (ensembl2entrez, entrez2ensembl) dictionaries.'''
+    ensembl2entrez_li = get_shared_table('ensembl2entrez_li')
+    return list2dict(ensembl2entrez_li, 0), list2dict(ensembl2entrez_li, 1)
+
+
+def get_shared_table(name):
+    '''return a parsed table ("ensembl2entrez_li" or "ensembl2entrez_maps"),
+       which is parsed only once per Ensembl release, and shared in the process.
+    '''
+    if name not in _shared_tables:
+        if name == 'ensembl2entrez_li':
+            _shared_tables[name] = _parse_ensembl2entrez_li()
+        elif name == 'ensembl2entrez_maps':
+            _shared_tables[name] = _parse_ensembl2entrez_maps()
+        else:
+            raise ValueError('Unknown table "%s".' % name)
+    return _shared_tables[name]
+
+
+def clear_shared_tables():
+    '''free the tables shared in the process (see get_shared_table), e.g.
+       after the last ensembl_* source is uploaded.
+    '''
+    _shared_tables.clear()
+
+
 class EnsemblParser:
     def __init__(self):
         self.ensembl2entrez_li = None
-        self.ensembl_main = None
 
     def _load_ensembl_2taxid(self):
         """ensembl2taxid"""
@@ -51,13 +97,10 @@ class EnsemblParser:
         return ensembl2name
 
     def _load_ensembl2entrez_li(self):
-        """gene_ensembl__xref_entrezgene__dm"""
-        DATAFILE = os.path.join(DATA_FOLDER, 'gene_ensembl__xref_entrezgene__dm.txt')
-        load_start(DATAFILE)
-        ensembl2entrez_li = tab2list(DATAFILE, (1,2), includefn=_not_LRG)   # [(ensembl_gid, entrez_gid),...]
-        load_done('[%d]' % len(ensembl2entrez_li))
-        self.ensembl2entrez_li = ensembl2entrez_li
+        self.ensembl2entrez_li = get_shared_table('ensembl2entrez_li')
 
+    @parsed_cache(files=lambda self: ENSEMBL_MAIN_DATAFILES, params=lambda self: None,
+                  name='ensembl.ensembl_main')
     def load_ensembl_main(self):
         em2name = self._load_ensembl2name()
         em2taxid = self._load_ensembl_2taxid()
@@ -136,43 +179,42 @@ class EnsemblParser:
 
     def convert2entrez(self, ensembl2x):
         '''convert a dict with ensembl gene ids as the keys to matching entrezgene ids as the keys.'''
-        if not self.ensembl2entrez_li:
-            self._load_ensembl2entrez_li()
-
-        if not self.ensembl_main:
-            self.ensembl_main = self.load_ensembl_main()
-
-        ensembl2entrez = list2dict(self.ensembl2entrez_li, 0)
-        entrez2ensembl = list2dict(self.ensembl2entrez_li, 1)
-
-        #Now make a dictionary indexed by entrez gene id
-        print '# of ensembl IDs in total: %d' % len(set(ensembl2x) | set(ensembl2entrez))
-        print '# of ensembl IDs match entrez Gene IDs: %d' % len(set(ensembl2x) & set(ensembl2entrez))
-        print '# of ensembl IDs DO NOT match entrez Gene IDs: %d' % len(set(ensembl2x) - set(ensembl2entrez))
-
-        #all genes with matched entrez
-        def _fn(eid, taxid=None):
-            d = copy.copy(ensembl2x.get(eid, {}))    #need to make a copy of the value here.
-            return d                                    #otherwise, it will cause issue when multiple entrezgene ids
-                                                        #match the same ensembl gene, for example,
-                                                        #      ENSMUSG00000027104 --> (11909, 100047997)
-
-        data = value_convert(entrez2ensembl, _fn)
+        ensembl2entrez, entrez2ensembl = get_shared_table('ensembl2entrez_maps')
+
+        #each set of ensembl ids is computed only once
+        x_ids = set(ensembl2x)
+        matched_ids = x_ids.intersection(ensembl2entrez)
+        unmatched_ids = x_ids - matched_ids
+        print '# of ensembl IDs in total: %d' % (len(ensembl2entrez) + len(unmatched_ids))
+        print '# of ensembl IDs match entrez Gene IDs: %d' % len(matched_ids)
+        print '# of ensembl IDs DO NOT match entrez Gene IDs: %d' % len(unmatched_ids)
+
+        #ensembl2x is owned by the caller, so each doc is normalized in place only once
+        for eid in x_ids:
+            dict_nodup(ensembl2x[eid], sort=True)
+
+        #hash join on ensembl gene ids. entrez2ensembl is shared, so do not modify it in place
+        data = {}
+        for entrez_id, eid in entrez2ensembl.iteritems():
+            if type(eid) is types.ListType:
+                #if one entrez gene matches multiple ensembl genes, merge their docs
+                data[entrez_id] = dict_attrmerge([ensembl2x.get(_eid, {}) for _eid in eid],
+                                                 removedup=True, sort=True)
+            else:
+                doc = ensembl2x.get(eid, None)
+                if doc is None:
+                    data[entrez_id] = {}
+                elif type(ensembl2entrez[eid]) is types.ListType:
+                    #need to make a copy of the doc here, when multiple entrezgene ids
+                    #match the same ensembl gene, for example,
+                    #      ENSMUSG00000027104 --> (11909, 100047997)
+                    data[entrez_id] = copy.copy(doc)
+                else:
+                    data[entrez_id] = doc
 
         #add those has no matched entrez geneid, using ensembl id as the key
-        for eid in (set(ensembl2x) - set(ensembl2entrez)):
-            _g = ensembl2x[eid]
-            #_g.update(self.ensembl_main.get(eid, {}))
-            data[eid] = _g
-
-        doc_li = []
-        for id in data:
-            if type(data[id]) is types.DictType:
-                _doc = dict_nodup(data[id], sort=True)
-            else:
-                #if one entrez gene matches multiple ensembl genes
-                _doc = dict_attrmerge(data[id], removedup=True, sort=True)
-            data[id] = _doc
+        for eid in unmatched_ids:
+            data[eid] = ensembl2x[eid]
 
         return data
 
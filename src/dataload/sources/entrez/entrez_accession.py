@@ -12,6 +12,11 @@ def load_genedoc(self):
     gene2acc = parser.load()
     return gene2acc
 
+def load_genedoc_iter(self):
+    parser = Gene2AccessionParser()
+    parser.set_all_species()
+    return parser.load_iter()
+
 def get_mapping(self):
     mapping = {
         "accession": {"dynamic": False,
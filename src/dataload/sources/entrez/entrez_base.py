@@ -3,15 +3,55 @@ from config import species_li, taxid_d, DATA_ARCHIVE_ROOT
 from utils.common import file_newer, loadobj, dump
 from dataload import get_data_folder
 from utils.dataload import (load_start, load_done,
-                            tab2dict, tab2list, value_convert, normalized_value,
-                            dict_convert, dict_to_list,
+                            tab2dict, tab2list, tab2dict_iter, value_convert, normalized_value,
+                            dict_convert, dict_to_list, parsed_cache
                             )
 
 #DATA_FOLDER = os.path.join(DATA_ARCHIVE_ROOT, 'by_resources/entrez/current')
 DATA_FOLDER = get_data_folder('entrez')
 print('DATA_FOLDER: ' + DATA_FOLDER)
 
+
+def cached_load(load):
+    '''cache the output of the load (or load_iter) method of a parser on disk
+       (see parsed_cache), named "entrez.<parser class>.<method name>", and keyed
+       by species_li, cols, key, aggregate, load arguments, and input files from
+       get_input_files. A generator method is cached as an iterator, so that
+       get_genedoc_iter (see dataload.GeneDocSource) streams from the cache too.
+    '''
+    import functools
+    import inspect
+    cached_load_d = {}    # {parser class name: cached load}
+
+    @functools.wraps(load)
+    def _load(self, *args, **kwargs):
+        cls_name = self.__class__.__name__
+        if cls_name not in cached_load_d:
+            cached_load_d[cls_name] = parsed_cache(
+                files=lambda self, *args, **kwargs: self.get_input_files(),
+                params=lambda self, *args, **kwargs: (self.species_li, self.cols, self.key, self.aggregate,
+                                                      args, sorted(kwargs.items())),
+                name='entrez.%s.%s' % (cls_name, load.__name__),
+                iterator=inspect.isgeneratorfunction(load))(load)
+        return cached_load_d[cls_name](self, *args, **kwargs)
+    return _load
+
+
 class EntrezParserBase(object):
+    #for a tab-delimited DATAFILE, subclasses can declare columns to load, the
+    #key column (index in cols) and how values of the same key are aggregated
+    #(see list2dict in utils.dataload), and then call self.load_tab2dict().
+    cols = None
+    key = 0
+    aggregate = None
+    #number of processes to parse DATAFILE in chunks (all CPUs if None), see
+    #tab2dict. Only set it for parsers measured to benefit, as each forked
+    #worker holds everything referenced by includefn (e.g. geneid_d).
+    #Files like ".gz" not in BGZF format are always parsed sequentially.
+    processes = 1
+    #other input files (under DATA_FOLDER) used by load
+    EXTRA_DATAFILES = []
+
     def __init__(self):
         #if species_li is None, include all species
         self.set_species_li(species_li)
@@ -33,6 +73,15 @@ class EntrezParserBase(object):
         else:
             self.set_all_species()
 
+    def get_input_files(self):
+        '''return a list of input files, used as a part of the cache key in cached_load.'''
+        return [self.datafile] + [os.path.join(self.DATA_FOLDER, f) for f in self.EXTRA_DATAFILES]
+
+    def load_tab2dict(self, includefn=None):
+        '''load DATAFILE into a dictionary based on cols, key and aggregate.'''
+        return tab2dict(self.datafile, self.cols, self.key, aggregate=self.aggregate,
+                        includefn=includefn, processes=self.processes)
+
     def load(self, aslist=False):
         raise NotImplementedError
 
@@ -40,7 +89,10 @@ class EntrezParserBase(object):
 class GeneInfoParser(EntrezParserBase):
     '''Parser for NCBI gene_info.gz file.'''
     DATAFILE = 'gene/gene_info.gz'
+    cols = (0,1,2,4,5,7,8,9)
+    key = 1
 
+    @cached_load
     def load(self, aslist=False):
         '''
         loading ncbi "gene_info" file
@@ -54,36 +106,8 @@ class GeneInfoParser(EntrezParserBase):
 
         '''
         load_start(self.datafile)
-        gene_d = tab2dict(self.datafile, (0,1,2,4,5,7,8,9), key=1, alwayslist=0, includefn=self.species_filter)
-        def _ff(d):
-            (taxid, symbol, synonyms,
-            dbxrefs,map_location,
-            description, type_of_gene) = d
-            out = dict(taxid=int(taxid),
-                       symbol = symbol,
-                       name=description)
-            if map_location != '-':
-                out['map_location']=map_location
-            if type_of_gene != '-':
-                out['type_of_gene']=type_of_gene
-            if synonyms != '-':
-               out['alias']=normalized_value(synonyms.split('|'))
-
-            for x in dbxrefs.split('|'):
-                if x=='-': continue
-                try:
-                    _db, _id = x.split(':')
-                except:
-                    print x
-                    raise
-                if _db.lower() in ['ensembl', 'imgt/gene-db']:      # we don't need ensembl xref from here, we will get it from Ensembl directly
-                    continue                                        # we don't need 'IMGT/GENE-DB" xref either, because they are mostly the same as gene symbol
-                if _db.lower() == 'mgi':            # add "MGI:" prefix for MGI ids.
-                    _id = "MGI:"+_id
-                out[_db] = _id
-            return out
-
-        gene_d = value_convert(gene_d, _ff)
+        gene_d = self.load_tab2dict(includefn=self.species_filter)
+        gene_d = value_convert(gene_d, self._convert)
 
         #add entrezgene field
         for geneid in gene_d:
@@ -98,6 +122,42 @@ class GeneInfoParser(EntrezParserBase):
         else:
             return gene_d
 
+    @cached_load
+    def load_iter(self):
+        '''same as load, but yield (geneid, genedoc) pairs one at a time.'''
+        for geneid, d in tab2dict_iter(self.datafile, self.cols, self.key,
+                                       includefn=self.species_filter):
+            doc = self._convert(d)
+            doc['entrezgene'] = int(geneid)
+            yield geneid, doc
+
+    def _convert(self, d):
+        (taxid, symbol, synonyms,
+        dbxrefs,map_location,
+        description, type_of_gene) = d
+        out = dict(taxid=int(taxid),
+                   symbol = symbol,
+                   name=description)
+        if map_location != '-':
+            out['map_location']=map_location
+        if type_of_gene != '-':
+            out['type_of_gene']=type_of_gene
+        if synonyms != '-':
+           out['alias']=normalized_value(synonyms.split('|'))
+
+        for x in dbxrefs.split('|'):
+            if x=='-': continue
+            try:
+                _db, _id = x.split(':')
+            except:
+                print x
+                raise
+            if _db.lower() in ['ensembl', 'imgt/gene-db']:      # we don't need ensembl xref from here, we will get it from Ensembl directly
+                continue                                        # we don't need 'IMGT/GENE-DB" xref either, because they are mostly the same as gene symbol
+            if _db.lower() == 'mgi':            # add "MGI:" prefix for MGI ids.
+                _id = "MGI:"+_id
+            out[_db] = _id
+        return out
 
 
 def get_geneid_d(species_li=None, load_cache=True, save_cache=True):
@@ -169,6 +229,7 @@ def get_geneid_d(species_li=None, load_cache=True, save_cache=True):
 class HomologeneParser(EntrezParserBase):
     '''Parser for NCBI homologenes.data file.'''
     DATAFILE = 'Homologene/homologene.data'
+    EXTRA_DATAFILES = ['gene/gene_info.gz', 'gene/gene_history.gz']    #for geneid_d
 
     def _sorted_homologenes(self, homologenes):
         '''sort list of homologenes [(taxid, geneid),...] based on the order
@@ -180,6 +241,7 @@ class HomologeneParser(EntrezParserBase):
         gene_li = [(d.get(taxid, taxid), taxid, geneid) for taxid, geneid in homologenes]
         return [g[1:] for g in sorted(gene_li)]
 
+    @cached_load
     def load(self, aslist=False):
         '''
         loading ncbi "homologene.data" file
@@ -222,6 +284,7 @@ class GeneSummaryParser(EntrezParserBase):
     '''Parser for gene2summary_all.txt, adding "summary" field in gene doc'''
     DATAFILE = 'refseq/gene2summary_all.txt'
 
+    @cached_load
     def load(self, aslist=False):
         load_start(self.datafile)
         with file(self.datafile) as df:
@@ -244,34 +307,14 @@ class GeneSummaryParser(EntrezParserBase):
 class Gene2AccessionParserBase(EntrezParserBase):
     DATAFILE = 'to_be_specified'
     fieldname = 'to_be_specified'
+    cols = (1,3,5,7)
+    aggregate = 'list'
 
+    @cached_load
     def load(self, aslist=False):
         load_start(self.datafile)
-        gene2acc = tab2dict(self.datafile, (1,3,5,7), 0, alwayslist=1,
-                            includefn=self.species_filter)
-        def _ff(d):
-            out = {'rna':[],
-                   'protein':[],
-                   'genomic':[]}
-            for x1,x2,x3 in d:
-                if x1!='-':
-                    out['rna'].append(x1.split('.')[0])   #trim version number after dot
-                if x2!='-':
-                    out['protein'].append(x2.split('.')[0])
-                if x3!='-':
-                    out['genomic'].append(x3.split('.')[0])
-            #remove dup
-            for k in out:
-                out[k] = normalized_value(out[k])
-            #remove empty rna/protein/genomic field
-            _out = {}
-            for k,v in out.items():
-                if v: _out[k] = v
-            if _out:
-                _out = {self.fieldname:_out}
-            return _out
-
-        gene2acc = dict_convert(gene2acc, valuefn=_ff)
+        gene2acc = self.load_tab2dict(includefn=self.species_filter)
+        gene2acc = dict_convert(gene2acc, valuefn=self._convert)
         load_done('[%d]' % len(gene2acc))
 
         if aslist:
@@ -279,6 +322,37 @@ class Gene2AccessionParserBase(EntrezParserBase):
         else:
             return gene2acc
 
+    @cached_load
+    def load_iter(self):
+        '''same as load, but yield (geneid, genedoc) pairs one at a time.
+           Rows of the same gene must be next to each other in DATAFILE.
+        '''
+        for geneid, d in tab2dict_iter(self.datafile, self.cols, self.key, alwayslist=True,
+                                       includefn=self.species_filter):
+            yield geneid, self._convert(d)
+
+    def _convert(self, d):
+        out = {'rna':[],
+               'protein':[],
+               'genomic':[]}
+        for x1,x2,x3 in d:
+            if x1!='-':
+                out['rna'].append(x1.split('.')[0])   #trim version number after dot
+            if x2!='-':
+                out['protein'].append(x2.split('.')[0])
+            if x3!='-':
+                out['genomic'].append(x3.split('.')[0])
+        #remove dup
+        for k in out:
+            out[k] = normalized_value(out[k])
+        #remove empty rna/protein/genomic field
+        _out = {}
+        for k,v in out.items():
+            if v: _out[k] = v
+        if _out:
+            _out = {self.fieldname:_out}
+        return _out
+
 class Gene2AccessionParser(Gene2AccessionParserBase):
     DATAFILE = 'gene/gene2accession.gz'
     fieldname = 'accession'
@@ -290,12 +364,15 @@ class Gene2RefseqParser(Gene2AccessionParserBase):
 
 class Gene2UnigeneParser(EntrezParserBase):
     DATAFILE = 'gene/gene2unigene'
+    cols = (0,1)
+    EXTRA_DATAFILES = ['gene/gene_info.gz', 'gene/gene_history.gz']    #for geneid_d
+
+    @cached_load
     def load(self, aslist=False):
         load_start(self.datafile)
         print
         geneid_d = get_geneid_d(self.species_li)
-        gene2unigene = tab2dict(self.datafile, (0,1), 0, alwayslist=0,
-                                includefn=lambda ld:int(ld[0]) in geneid_d)
+        gene2unigene = self.load_tab2dict(includefn=lambda ld:int(ld[0]) in geneid_d)
         gene_d = {}
         for gid, unigene in gene2unigene.items():
             gene_d[gid] = {'unigene': unigene}
@@ -308,11 +385,13 @@ class Gene2UnigeneParser(EntrezParserBase):
 
 class Gene2GOParser(EntrezParserBase):
     DATAFILE = 'gene/gene2go.gz'
+    cols = (1,2,3,4,5,6,7)
+    aggregate = 'list'
 
+    @cached_load
     def load(self, aslist=False):
         load_start(self.datafile)
-        gene2go = tab2dict(self.datafile, (1,2,3,4,5,6,7), 0, alwayslist=1,
-                           includefn=self.species_filter)
+        gene2go = self.load_tab2dict(includefn=self.species_filter)
         category_d = {'Function': 'MF',
                       'Process':  'BP',
                       'Component': 'CC'}
@@ -362,14 +441,17 @@ class Gene2RetiredParser(EntrezParserBase):
     '''
 
     DATAFILE = 'gene/gene_history.gz'
+    cols = (1,2)
+    aggregate = 'list'
+
+    @cached_load
     def load(self, aslist=False):
         load_start(self.datafile)
         if self.species_li:
             _includefn = lambda ld:int(ld[0]) in self.taxid_set and ld[1]!='-'
         else:
             _includefn = lambda ld: ld[1]!='-'
-        gene2retired = tab2dict(self.datafile, (1,2), 0, alwayslist=1,
-                                includefn=_includefn)
+        gene2retired = self.load_tab2dict(includefn=_includefn)
         gene2retired = dict_convert(gene2retired, valuefn=lambda x: normalized_value([int(xx) for xx in x]))
 
         gene_d = {}
@@ -393,6 +475,7 @@ class Gene2ECParser(EntrezParserBase):
     '''
     DATAFILE = 'refseq/gene2ec_all.txt'
 
+    @cached_load
     def load(self, aslist=False):
         load_start(self.datafile)
         with file(self.datafile) as df:
@@ -421,10 +504,13 @@ class Gene2GeneRifParser(EntrezParserBase):
     '''
     '''
     DATAFILE = 'generif/generifs_basic.gz'
+    cols = (1, 2, 4)
+    aggregate = 'list'
 
+    @cached_load
     def load(self):
         load_start(self.datafile)
-        gene2generif = tab2dict(self.datafile, (1, 2, 4), 0, alwayslist=1)
+        gene2generif = self.load_tab2dict()
         gene2generif = dict_convert(gene2generif, valuefn=lambda v: {'generif': [dict(pubmed=x[0], text=x[1]) for x in v]})
         load_done('[%d]' % len(gene2generif))
         return gene2generif
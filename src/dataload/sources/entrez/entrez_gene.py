@@ -33,6 +33,11 @@ def load_genedoc(self):
     genedoc_d = parser.load()
     return genedoc_d
 
+def load_genedoc_iter(self):
+    parser = GeneInfoParser()
+    parser.set_all_species()
+    return parser.load_iter()
+
 def get_mapping(self):
     mapping = {
         "entrezgene": {"type": "long"},
@@ -12,6 +12,11 @@ def load_genedoc(self):
     gene2refseq = parser.load()
     return gene2refseq
 
+def load_genedoc_iter(self):
+    parser = Gene2RefseqParser()
+    parser.set_all_species()
+    return parser.load_iter()
+
 def get_mapping(self):
     mapping = {
         "refseq":    {"dynamic": False,
@@ -3,9 +3,7 @@ import types
 import time
 from utils.common import timesofar
 from utils.dataload import (load_start, load_done,
-                            listitems, dupline_seperator,
-                            tabfile_feeder, list2dict, list_nondup,
-                            value_convert)
+                            tabfile_feeder, list2dict)
 from config import DATA_ARCHIVE_ROOT
 from dataload import get_data_folder
 
@@ -44,86 +42,146 @@ def _dict_convert(uniprot_li):
     return {'uniprot': _dict}
 
 
-def load_uniprot():
-    print('DATA_FOLDER: ' + DATA_FOLDER)
-    DATAFILE = os.path.join(DATA_FOLDER, 'idmapping_selected.tab.gz')
-    load_start(DATAFILE)
-    t0 = time.time()
-    xli = []
-    for ld in tabfile_feeder(DATAFILE, header=1):
-        ld = listitems(ld, *(0,1,2,19))    #UniProtKB-AC UniProtKB-ID GeneID Ensembl(Gene)
-        for value in dupline_seperator(dupline=ld,
-                                       dup_idx=[2,3],   #GeneID and EnsemblID columns may have duplicates
-                                       dup_sep='; '):
-            value = list(value)
-            value[1] = get_uniprot_section(value[1])
-            value = tuple(value)
-            xli.append(value)
-
-    ensembl2geneid = list2dict([(x[3], x[2]) for x in xli if x[2]!='' and x[3]!=''], 0, alwayslist=True)
-    xli2 = []
-    for uniprot_acc, section, entrez_id, ensembl_id in xli:
-        if entrez_id:
-            xli2.append((uniprot_acc, section, entrez_id))
-        elif ensembl_id:
-            entrez_id = ensembl2geneid.get(ensembl_id, None)
-            if entrez_id:
-                #if ensembl_id can be mapped to entrez_id
-                for _eid in entrez_id:
-                    xli2.append((uniprot_acc, section, _eid))
-            else:
-                #otherwise, just use ensembl_id
-                xli2.append((uniprot_acc, section, ensembl_id))
+#fields from other columns of idmapping_selected.tab:
+#   fieldname: (column index, value converter)
+IDMAPPING_X_FIELDS = {
+    'pdb': (5, lambda pdb_id: pdb_id.split(':')[0]),
+    'ipi': (7, None),
+    'pir': (12, None)
+}
 
-    gene2uniprot = list2dict(list_nondup(xli2), 2, alwayslist=True)
-    gene2uniprot = value_convert(gene2uniprot, _dict_convert, traverse_list=False)
-    load_done('[%d, %s]' % (len(gene2uniprot), timesofar(t0)))
 
-    return gene2uniprot
+def _to_x_value(value_set):
+    if len(value_set) == 1:
+        return list(value_set)[0]
+    else:
+        return sorted(value_set)
 
 
-def load_x(idx, fieldname, cvt_fn=None):
+def scan_idmapping(x_fields=IDMAPPING_X_FIELDS, with_uniprot=True):
+    '''scan idmapping_selected.tab.gz once, and return a dictionary of:
+         {'ensembl2geneid': {<ensembl_id>: [<entrez_id>,...]},
+          'uniprot': <genedoc_d with "uniprot" field>,   #if with_uniprot
+          <fieldname>: <genedoc_d with <fieldname> field>,...}   #for each of x_fields
+       Rows without GeneID are kept aside, and mapped to Entrez gene ids via
+       their Ensembl gene ids (or keep Ensembl gene ids if not mapped) after the scan.
+    '''
     print('DATA_FOLDER: ' + DATA_FOLDER)
     DATAFILE = os.path.join(DATA_FOLDER, 'idmapping_selected.tab.gz')
     load_start(DATAFILE)
     t0 = time.time()
-    xli = []
-    for ld in tabfile_feeder(DATAFILE, header=1):
-        ld = listitems(ld, *(2,19,idx))    # GeneID Ensembl(Gene) target_value
-        for value in dupline_seperator(dupline=ld,
-                                       dup_sep='; '):
-            xli.append(value)
-
-    ensembl2geneid = list2dict(list_nondup([(x[1], x[0]) for x in xli if x[0]!='' and x[1]!='']), 0, alwayslist=True)
-    xli2 = []
-    for entrez_id, ensembl_id, x_value in xli:
-        if x_value:
-            if cvt_fn:
-                x_value = cvt_fn(x_value)
+    x_fields = sorted(x_fields.items())
+    #UniProtKB-AC UniProtKB-ID GeneID Ensembl(Gene) x_field1 x_field2 ...
+    cols = (0,1,2,19) + tuple([idx for fieldname, (idx, cvt_fn) in x_fields])
+    ensembl2geneid = {}
+    gene2uniprot = {}
+    gene2x_li = [{} for x in x_fields]
+    unmapped_li = []
+
+    def _add(gene_id, uniprot_value, x_values_li):
+        if with_uniprot:
+            gene2uniprot.setdefault(gene_id, set()).add(uniprot_value)
+        for gene2x, x_values in zip(gene2x_li, x_values_li):
+            if x_values:
+                gene2x.setdefault(gene_id, set()).update(x_values)
+
+    for ld in tabfile_feeder(DATAFILE, header=1, cols=cols):
+        uniprot_acc, uniprot_id, entrez_ids, ensembl_ids = ld[:4]
+        entrez_ids = entrez_ids.split('; ')      #GeneID and EnsemblID columns may have duplicates
+        ensembl_ids = ensembl_ids.split('; ')
+        for entrez_id in entrez_ids:
             if entrez_id:
-                xli2.append((entrez_id, x_value))
-            elif ensembl_id:
-                entrez_id = ensembl2geneid.get(ensembl_id, None)
-                if entrez_id:
-                    for _eid in entrez_id:
-                        xli2.append((_eid, x_value))
-                else:
-                    xli2.append((ensembl_id, x_value))
+                for ensembl_id in ensembl_ids:
+                    if ensembl_id:
+                        geneid_li = ensembl2geneid.setdefault(ensembl_id, [])
+                        if entrez_id not in geneid_li:
+                            geneid_li.append(entrez_id)
+
+        x_values_li = []
+        for (fieldname, (idx, cvt_fn)), x_value in zip(x_fields, ld[4:]):
+            x_values = [x for x in x_value.split('; ') if x]
+            if cvt_fn:
+                x_values = [cvt_fn(x) for x in x_values]
+            x_values_li.append(x_values)
+        if with_uniprot:
+            uniprot_value = (uniprot_acc, get_uniprot_section(uniprot_id))
+        else:
+            uniprot_value = None
+
+        if entrez_ids != ['']:
+            for entrez_id in entrez_ids:
+                _add(entrez_id, uniprot_value, x_values_li)
+        elif ensembl_ids != ['']:
+            unmapped_li.append((uniprot_value, ensembl_ids, x_values_li))
+
+    for uniprot_value, ensembl_ids, x_values_li in unmapped_li:
+        for ensembl_id in ensembl_ids:
+            if ensembl_id:
+                #if ensembl_id can be mapped to entrez_id, otherwise, just use ensembl_id
+                for gene_id in ensembl2geneid.get(ensembl_id, None) or [ensembl_id]:
+                    _add(gene_id, uniprot_value, x_values_li)
+    del unmapped_li
+
+    out = {'ensembl2geneid': ensembl2geneid}
+    if with_uniprot:
+        out['uniprot'] = dict([(gene_id, _dict_convert(list(value_set)))
+                               for gene_id, value_set in gene2uniprot.iteritems()])
+    for (fieldname, (idx, cvt_fn)), gene2x in zip(x_fields, gene2x_li):
+        out[fieldname] = dict([(gene_id, {fieldname: _to_x_value(value_set)})
+                               for gene_id, value_set in gene2x.iteritems()])
+    load_done('[%s, %s]' % (', '.join(['%s: %d' % (k, len(v)) for k, v in sorted(out.items())]),
+                            timesofar(t0)))
+    return out
+
+
+#genedoc_d outputs from scan_idmapping, shared by uniprot, uniprot_pdb and
+#uniprot_pir sources in the same upload run. Each of them is removed once
+#taken, and the cache is emptied after the last one.
+_idmapping_cache = {}
+
+
+def _get_idmapping_fields(name):
+    '''return (x_fields, with_uniprot) parameters of scan_idmapping for the
+       outputs of uniprot sources being uploaded (dataload.__sources__, set at
+       runtime, e.g. by dataload.main), plus the output "name".
+    '''
+    import dataload
+    src_li = [src.split('.')[-1] for src in dataload.__sources__ or []
+              if src.split('.')[0] == 'uniprot']
+    x_fields = dict([(fieldname, x) for fieldname, x in IDMAPPING_X_FIELDS.items()
+                     if fieldname == name or 'uniprot_' + fieldname in src_li])
+    with_uniprot = name == 'uniprot' or 'uniprot' in src_li
+    return x_fields, with_uniprot
+
+
+def get_idmapping_output(name):
+    '''return a genedoc_d output of scan_idmapping ("uniprot" or one of
+       IDMAPPING_X_FIELDS). idmapping_selected.tab.gz is scanned only once for
+       the outputs of all enabled uniprot sources, as long as it is not changed.
+    '''
+    datafile = os.path.join(DATA_FOLDER, 'idmapping_selected.tab.gz')
+    file_key = (datafile, os.path.getmtime(datafile), os.path.getsize(datafile))
+    if _idmapping_cache.get('file_key', None) != file_key or name not in _idmapping_cache:
+        _idmapping_cache.clear()
+        x_fields, with_uniprot = _get_idmapping_fields(name)
+        _idmapping_cache.update(scan_idmapping(x_fields, with_uniprot=with_uniprot))
+        del _idmapping_cache['ensembl2geneid']
+        _idmapping_cache['file_key'] = file_key
+    out = _idmapping_cache.pop(name)
+    if _idmapping_cache.keys() == ['file_key']:
+        _idmapping_cache.clear()
+    return out
 
-    gene2x = list2dict(list_nondup(xli2), 0)
-    fn = lambda value: {fieldname: sorted(value) if type(value) is types.ListType else value}
-    gene2x = value_convert(gene2x, fn, traverse_list=False)
-    load_done('[%d, %s]' % (len(gene2x), timesofar(t0)))
 
-    return gene2x
+def load_uniprot():
+    return get_idmapping_output('uniprot')
 
 
 def load_pdb():
-    fn = lambda pdb_id: pdb_id.split(':')[0]
-    return load_x(idx=5, fieldname='pdb', cvt_fn=fn)
+    return get_idmapping_output('pdb')
 
 def load_ipi():
-    return load_x(idx=7, fieldname='ipi')
+    return get_idmapping_output('ipi')
 
 def load_pir():
-    return load_x(idx=12, fieldname='pir')
+    return get_idmapping_output('pir')
@@ -176,33 +176,139 @@ def file_newer(source, target):
     return os.stat(source)[-2] > os.stat(target)[-2]
 
 
-def dump(object, filename, bin=1):
-    '''Saves a compressed object to disk
+# compressors for dump/dump2gridfs, in the order of preference for compress='auto'.
+# loadobj detects the format from the magic bytes at the beginning.
+COMPRESSORS = ['zstd', 'lz4', 'gzip']
+_COMPRESSOR_MAGIC = {
+    'gzip': '\x1f\x8b',
+    'zstd': '\x28\xb5\x2f\xfd',
+    'lz4': '\x04\x22\x4d\x18'
+}
+_IO_CHUNK_SIZE = 1024 * 1024
+
+
+class _Lz4CompressObj(object):
+    '''a zlib-like compressor object for the lz4 frame format.'''
+    def __init__(self, level=None):
+        import lz4.frame
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level or 0)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        out = self._compressor.compress(data)
+        if self._header:
+            out = self._header + out
+            self._header = None
+        return out
+
+    def flush(self):
+        return (self._header or '') + self._compressor.flush()
+
+
+def _get_compressor_name(compress):
+    '''return the first available compressor for "auto", otherwise compress itself.'''
+    if compress != 'auto':
+        return compress
+    for compress in COMPRESSORS:
+        try:
+            if compress == 'zstd':
+                import zstandard
+            elif compress == 'lz4':
+                import lz4.frame
+            return compress
+        except ImportError:
+            continue
+
+
+def _get_compressobj(compress, level=None):
+    '''return a compressor object with zlib-like compress and flush methods.'''
+    if compress == 'gzip':
+        import zlib
+        return zlib.compressobj(level or 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compress == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level or 3).compressobj()
+    elif compress == 'lz4':
+        return _Lz4CompressObj(level)
+    else:
+        raise ValueError('Invalid compress "%s".' % compress)
+
+
+def _get_decompressobj(magic):
+    '''return a decompressor object based on the magic bytes of the data,
+       or None if the data is not compressed.
+    '''
+    if magic.startswith(_COMPRESSOR_MAGIC['gzip']):
+        import zlib
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif magic.startswith(_COMPRESSOR_MAGIC['zstd']):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    elif magic.startswith(_COMPRESSOR_MAGIC['lz4']):
+        import lz4.frame
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+class _CompressedWriter(object):
+    '''a write-only file-like object, which compresses the data written in
+       chunks of _IO_CHUNK_SIZE into fobj.
     '''
-    import gzip
+    def __init__(self, fobj, compress, level=None):
+        self._fobj = fobj
+        self._compressobj = _get_compressobj(compress, level)
+        self._buffer = []
+        self._buffer_size = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= _IO_CHUNK_SIZE:
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        if self._buffer:
+            self._fobj.write(self._compressobj.compress(''.join(self._buffer)))
+            self._buffer = []
+            self._buffer_size = 0
+
+    def close(self):
+        self._flush_buffer()
+        self._fobj.write(self._compressobj.flush())
+
+
+def _dump_to_fobj(object, fobj, bin=-1, compress='gzip', level=None):
     import cPickle as pickle
+    writer = _CompressedWriter(fobj, _get_compressor_name(compress), level)
+    pickle.dump(object, writer, protocol=bin)
+    writer.close()
+
+
+def dump(object, filename, bin=-1, compress='gzip', level=None):
+    '''Saves a compressed object to disk
+       bin is the pickle protocol, default is the highest one.
+       compress can be "gzip" (default), "zstd" or "lz4", or "auto" to pick the
+       first available one in COMPRESSORS. The faster ones are opt-in, since
+       a file from them cannot be loaded where the module is not installed.
+    '''
     print 'Dumping into "%s"...' % filename,
-    file = gzip.GzipFile(filename, 'wb')
-    pickle.dump(object, file, protocol=bin)
-    file.close()
+    with file(filename, 'wb') as out_f:
+        _dump_to_fobj(object, out_f, bin=bin, compress=compress, level=level)
     print 'Done. [%s]' % os.stat(filename).st_size
 
 
-def dump2gridfs(object, filename, db, bin=1):
-    '''Save a compressed object to MongoDB gridfs.'''
-    import gzip
+def dump2gridfs(object, filename, db, bin=-1, compress='gzip', level=None):
+    '''Save a compressed object to MongoDB gridfs.
+       See dump for bin, compress and level.
+    '''
     import gridfs
-    import cPickle as pickle
     print 'Dumping into "MongoDB:%s/%s"...' % (db.name, filename),
     fs = gridfs.GridFS(db)
     if fs.exists(_id=filename):
         fs.delete(filename)
-    fobj = fs.new_file(filename=filename, _id=filename)
+    fobj = fs.new_file(filename=filename, _id=filename, chunkSize=_IO_CHUNK_SIZE)
     try:
-        gzfobj = gzip.GzipFile(filename=filename, mode='wb', fileobj=fobj)
-        pickle.dump(object, gzfobj, protocol=bin)
+        _dump_to_fobj(object, fobj, bin=bin, compress=compress, level=level)
     finally:
-        gzfobj.close()
         fobj.close()
     print 'Done. [%s]' % fs.get(filename).length
 
@@ -213,8 +319,9 @@ def loadobj(filename, mode='file'):
            obj = loadobj('data.pyobj')
 
            obj = loadobj(('data.pyobj', mongo_db), mode='gridfs')
+       The compression format (or none) is detected from the data, and the
+       data is read and decompressed in chunks.
     '''
-    import gzip
     import cPickle as pickle
 
     if mode == 'gridfs':
@@ -227,17 +334,19 @@ def loadobj(filename, mode='file'):
             fobj = file(filename, 'rb')
         else:
             fobj = filename   # input is a file-like handler
-    gzfobj = gzip.GzipFile(fileobj=fobj)
     try:
-        buffer = ""
-        while 1:
-            data = gzfobj.read()
-            if data == "":
-                break
-            buffer += data
-        object = pickle.loads(buffer)
+        data = fobj.read(_IO_CHUNK_SIZE)
+        decompressobj = _get_decompressobj(data[:4])
+        chunks = []
+        while data:
+            if decompressobj:
+                data = decompressobj.decompress(data)
+            chunks.append(data)
+            data = fobj.read(_IO_CHUNK_SIZE)
+        data = ''.join(chunks)
+        del chunks
+        object = pickle.loads(data)
     finally:
-        gzfobj.close()
         fobj.close()
     return object
 
@@ -304,6 +413,57 @@ def iter_n(iterable, n):
         yield chunk
 
 
+def prefetch_iter(iterable, n=1):
+    '''return an iterator over <iterable>, which is consumed by a background
+       thread, keeping up to <n> items ahead of the consumer. Any exception
+       raised from <iterable> is re-raised to the consumer.
+    '''
+    import threading
+    import Queue
+
+    queue = Queue.Queue(maxsize=n)
+    stopped = threading.Event()
+
+    def _put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def _producer():
+        try:
+            for item in iterable:
+                if not _put((True, item)):
+                    break
+            else:
+                _put((False, None))
+        except Exception:
+            _put((False, sys.exc_info()))
+        finally:
+            # close the generator (e.g. a db cursor) within the same thread
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=_producer)
+    thread.daemon = True
+    thread.start()
+    try:
+        while 1:
+            has_item, item = queue.get()
+            if has_item:
+                yield item
+            elif item:
+                raise item[0], item[1], item[2]
+            else:
+                break
+    finally:
+        stopped.set()
+        thread.join()
+
+
 def send_s3_file(localfile, s3key, overwrite=False):
     '''save a localfile to s3 bucket with the given key.
        bucket is set via S3_BUCKET
@@ -19,7 +19,7 @@ import csv
 csv.field_size_limit(10000000)  #default is 131072, too small for some big files
 import json
 
-from utils.common import safewfile
+from utils.common import safewfile, dump, loadobj
 
 #===============================================================================
 # Misc. Utility functions
@@ -51,7 +51,7 @@ def listitems(list,*idx):
     else:
         return [list[i] for i in idx]
 
-def list2dict(list,keyitem,alwayslist=False):
+def list2dict(list,keyitem,alwayslist=False,aggregate=None):
     '''Return a dictionary with specified keyitem as key, others as values.
        keyitem can be an index or a sequence of indexes.
        For example: li=[['A','a',1],
@@ -62,28 +62,64 @@ def list2dict(list,keyitem,alwayslist=False):
        if alwayslist is True, values are always a list even there is only one item in it.
                     list2dict(li,0,True)---> {'A':[('a',1),('b',3)],
                                               'B':[('a',2),]}
+       list can be any iterable (e.g. a generator), it is consumed in a single pass.
+       aggregate sets how the values of the same key are aggregated:
+            None:    a single value, or a list of values if more than one (default)
+            'first': keep the first value only
+            'list':  always a list of values, same as alwayslist=True
+            'set':   a set of values
+            or a reducer function as fn(current_value, value), which returns the
+            new value, and current_value is the value itself for the first time.
     '''
+    if aggregate is None and alwayslist:
+        aggregate = 'list'
     dict={}
+
+    if aggregate is None:
+        def _add(key, value):
+            if key not in dict:
+                dict[key] = value
+            else:
+                current_value = dict[key]
+                if type(current_value) is types.ListType:
+                    current_value.append(value)
+                else:
+                    dict[key] = [current_value, value]
+    elif aggregate == 'first':
+        def _add(key, value):
+            if key not in dict:
+                dict[key] = value
+    elif aggregate == 'list':
+        def _add(key, value):
+            if key in dict:
+                dict[key].append(value)
+            else:
+                dict[key] = [value]
+    elif aggregate == 'set':
+        def _add(key, value):
+            if key in dict:
+                dict[key].add(value)
+            else:
+                dict[key] = set([value])
+    elif callable(aggregate):
+        def _add(key, value):
+            if key in dict:
+                dict[key] = aggregate(dict[key], value)
+            else:
+                dict[key] = value
+    else:
+        raise ValueError('Invalid aggregate "%s".' % aggregate)
+
     for x in list:
         if type(keyitem)==type(0):      #single item as key
             key=x[keyitem]
             value=tuple(x[:keyitem]+x[keyitem+1:])
         else:                           #
             key=tuple([x[i] for i in keyitem])
-            value=tuple([x[i] for i in range(len(list)) if i not in keyitem])
+            value=tuple([x[i] for i in range(len(x)) if i not in keyitem])
         if len(value) == 1:      #single value
             value=value[0]
-        if not dict.has_key(key):
-            if alwayslist:
-                dict[key] = [value,]
-            else:
-                dict[key]=value
-        else:
-            current_value=dict[key]
-            if type(current_value) != type([]):
-                current_value=[current_value,]
-            current_value.append(value)
-            dict[key]=current_value
+        _add(key, value)
     return dict
 
 def list_nondup(list):
@@ -122,13 +158,74 @@ def alwayslist(value):
 #===============================================================================
 # File Utility functions
 #===============================================================================
-def anyfile(infile, mode='r'):
+class PipeFile(object):
+    '''A read-only file handler for the stdout of an external process, e.g.
+       a decompressor. An IOError is raised at the end of the file if the
+       process exits with an error, so that a truncated output is not taken
+       as a complete one.
+    '''
+    def __init__(self, cmd, bufsize=1024 * 1024):
+        import subprocess
+        self.cmd = cmd
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=bufsize)
+        self._file = self._proc.stdout
+
+    def _check_eof(self):
+        if self._proc.wait() != 0:
+            raise IOError('"%s" failed with exit code %s.' % (' '.join(self.cmd), self._proc.returncode))
+
+    def read(self, *args):
+        data = self._file.read(*args)
+        if not data:
+            self._check_eof()
+        return data
+
+    def readline(self, *args):
+        line = self._file.readline(*args)
+        if not line:
+            self._check_eof()
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self._file.readline()
+        if not line:
+            self._check_eof()
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self._proc.poll() is None:
+            # closed before reaching the end
+            self._proc.terminate()
+        self._file.close()
+        self._proc.wait()
+
+    def __getattr__(self, attr):
+        return getattr(self._file, attr)
+
+def gzip_pipe(infile, bufsize=1024 * 1024):
+    '''return a PipeFile with the decompressed content of a gzip file, from an
+       external "pigz" (parallel gzip) or "gzip" process, so that decompression
+       runs on a separate core. Return None if neither is available.
+    '''
+    from distutils.spawn import find_executable
+    for cmd in ('pigz', 'gzip'):
+        cmd = find_executable(cmd)
+        if cmd:
+            return PipeFile([cmd, '-dc', infile], bufsize=bufsize)
+
+def anyfile(infile, mode='r', use_pipe=True):
     '''
     return a file handler with the support for gzip/zip comppressed files
     if infile is a two value tuple, then first one is the compressed file;
       the second one is the actual filename in the compressed file.
       e.g., ('a.zip', 'aa.txt')
-
+    if use_pipe is True, gzip files are decompressed by an external process
+      (see gzip_pipe) when reading, otherwise, or if not available, by zlib
+      with a large buffer.
     '''
     if type(infile) is types.TupleType:
         infile, rawfile = infile[:2]
@@ -137,7 +234,13 @@ def anyfile(infile, mode='r'):
     filetype = os.path.splitext(infile)[1].lower()
     if filetype == '.gz':
         import gzip
-        in_f = gzip.GzipFile(infile, 'r')
+        in_f = None
+        if use_pipe and mode.startswith('r'):
+            in_f = gzip_pipe(infile)
+        if in_f is None:
+            import io
+            in_f = gzip.GzipFile(infile, 'r')
+            in_f = io.BufferedReader(in_f, buffer_size=1024 * 1024)
     elif filetype == '.zip':
         import zipfile
         in_f = zipfile.ZipFile(infile, 'r').open(rawfile, 'r')
@@ -192,10 +295,52 @@ def dupline_seperator(dupline, dup_sep, dup_idx=None, strip=False):
         value_li[idx] = value
     return itertools.product(*value_li)    #itertools.product fits exactly the purpose here
 
-def tabfile_feeder(datafile, header=1, sep='\t', includefn=None, coerce_unicode=True):
-    '''a generator for each row in the file.'''
+def _get_pandas():
+    '''return pandas module if it is available, otherwise None.'''
+    try:
+        import pandas
+        return pandas
+    except ImportError:
+        return None
+
+def _tabfile_feeder_pandas(datafile, cols, header=1, sep='\t', coerce_unicode=True, chunksize=100000):
+    '''read only given cols from a file in chunks with pandas.'''
+    pandas = _get_pandas()
+    in_f = anyfile(datafile)
+    try:
+        reader = pandas.read_csv(in_f, sep=sep, header=None, skiprows=header,
+                                 usecols=sorted(set(cols)), dtype=str,
+                                 na_filter=False, chunksize=chunksize)
+        for chunk in reader:
+            for ld in chunk[list(cols)].itertuples(index=False):
+                # missing trailing fields come back as NaN, even with na_filter=False
+                ld = [x if isinstance(x, basestring) else '' for x in ld]
+                if coerce_unicode:
+                    yield [unicode(x, encoding='utf-8') for x in ld]
+                else:
+                    yield ld
+    finally:
+        in_f.close()
 
-    reader = csv.reader(anyfile(datafile),delimiter=sep)
+def tabfile_feeder(datafile, header=1, sep='\t', includefn=None, coerce_unicode=True, cols=None, engine='csv'):
+    '''a generator for each row in the file.
+       if cols is given (a list of column indexes), only these columns are
+       returned (and decoded) for each row.
+       includefn is called with the raw (not decoded) full row.
+       engine="pandas" reads the file in chunks with pandas instead (only when
+       cols is given and no includefn, and pandas is available); missing
+       fields are returned as "", same as empty fields.
+    '''
+    if engine == 'pandas' and cols is not None and includefn is None and \
+       type(datafile) is not types.TupleType:
+        if _get_pandas():
+            for ld in _tabfile_feeder_pandas(datafile, cols, header=header, sep=sep,
+                                             coerce_unicode=coerce_unicode):
+                yield ld
+            return
+
+    in_f = anyfile(datafile)
+    reader = csv.reader(in_f, delimiter=sep)
     lineno = 0
     try:
         for i in range(header):
@@ -205,6 +350,8 @@ def tabfile_feeder(datafile, header=1, sep='\t', includefn=None, coerce_unicode=
         for ld in reader:
             if not includefn or includefn(ld):
                 lineno += 1
+                if cols is not None:
+                    ld = [ld[i] for i in cols]
                 if coerce_unicode:
                     yield [unicode(x, encoding='utf-8') for x in ld]
                 else:
@@ -212,28 +359,63 @@ def tabfile_feeder(datafile, header=1, sep='\t', includefn=None, coerce_unicode=
     except ValueError:
         print "Error at line number:", lineno
         raise
+    finally:
+        in_f.close()
 
 def tab2list(datafile, cols, **kwargs):
     if os.path.exists(datafile):
         if type(cols) is type(1):
-            return [ld[cols] for ld in tabfile_feeder(datafile, **kwargs)]
+            return [ld[0] for ld in tabfile_feeder(datafile, cols=[cols], **kwargs)]
         else:
-            return [listitems(ld, *cols) for ld in tabfile_feeder(datafile, **kwargs)]
+            return list(tabfile_feeder(datafile, cols=cols, **kwargs))
     else:
         print 'Error: missing "%s". Skipped!' % os.path.split(datafile)[1]
         return {}
 
-def tab2dict(datafile, cols, key, alwayslist=False, **kwargs):
+def tab2dict(datafile, cols, key, alwayslist=False, aggregate=None, processes=1, **kwargs):
+    '''Return a dictionary from the given cols in a tab-delimited file, using
+       cols[key] as the key. Rows are streamed into the dictionary in a single pass.
+       See list2dict for "alwayslist" and "aggregate" parameters.
+       if processes is not 1, the file is parsed in chunks by a pool of
+       processes (see tabfile_map_reduce).
+    '''
     if type(datafile) is types.TupleType:
         _datafile = datafile[0]
     else:
         _datafile = datafile
     if os.path.exists(_datafile):
-        return list2dict([listitems(ld, *cols) for ld in tabfile_feeder(datafile, **kwargs)], key, alwayslist=alwayslist)
+        if processes != 1:
+            return tabfile_map_reduce(datafile, key=key, alwayslist=alwayslist,
+                                      aggregate=aggregate, cols=cols,
+                                      processes=processes, **kwargs)
+        return list2dict(tabfile_feeder(datafile, cols=cols, **kwargs), key,
+                         alwayslist=alwayslist, aggregate=aggregate)
     else:
         print 'Error: missing "%s". Skipped!' % os.path.split(_datafile)[1]
         return {}
 
+def tab2dict_iter(datafile, cols, key, alwayslist=False, recent_keys=100000, **kwargs):
+    '''Same as tab2dict, but yield (key, value) pairs one at a time, without
+       keeping all of them in memory. It requires rows with the same key are
+       next to each other in the file (e.g. grouped by the key, as NCBI gene
+       files are). To keep memory use constant, only the last <recent_keys>
+       keys are remembered, and a ValueError is raised if one of them appears
+       again. A key coming back after more keys than that is not detected
+       here (a delta upload raises on it, see GeneDocSource.load_delta).
+    '''
+    import collections
+    recent_q = collections.deque()
+    recent_set = set()
+    rows = tabfile_feeder(datafile, cols=cols, **kwargs)
+    for _key, group in itertools.groupby(rows, key=lambda ld: ld[key]):
+        if _key in recent_set:
+            raise ValueError('Rows of key "%s" are not next to each other in "%s".' % (_key, datafile))
+        recent_q.append(_key)
+        recent_set.add(_key)
+        if len(recent_q) > recent_keys:
+            recent_set.discard(recent_q.popleft())
+        yield list2dict(group, key, alwayslist=alwayslist).items()[0]
+
 def file_merge(infiles, outfile=None, header=1,verbose=1):
     '''merge a list of input files with the same format.
        if header will be removed from the 2nd files in the list.
@@ -260,6 +442,216 @@ def file_merge(infiles, outfile=None, header=1,verbose=1):
     print "="*20
     print "Done![total %d lines output]" % cnt
 
+#===============================================================================
+# Chunked multi-process parsing of a single tab-delimited file
+#===============================================================================
+BGZF_MAGIC = '\x1f\x8b\x08\x04'
+
+def _is_bgzf(datafile):
+    '''return True if datafile is in BGZF format (blocked gzip, as from "bgzip").'''
+    with open(datafile, 'rb') as in_f:
+        header = in_f.read(16)
+    return header[:4] == BGZF_MAGIC and header[12:14] == 'BC'
+
+def _bgzf_block_offsets(datafile):
+    '''yield the offset of each block in a BGZF file, reading block headers only.'''
+    import struct
+    with open(datafile, 'rb') as in_f:
+        offset = 0
+        while 1:
+            in_f.seek(offset)
+            header = in_f.read(18)
+            if len(header) < 18:
+                break
+            if header[:4] != BGZF_MAGIC or header[12:14] != 'BC':
+                raise IOError('Invalid BGZF block at %d in "%s".' % (offset, datafile))
+            yield offset
+            offset += struct.unpack('<H', header[16:18])[0] + 1
+
+def _open_chunkable(datafile, is_bgzf):
+    '''open a file supporting seek/tell at line boundaries. For BGZF files,
+       offsets are virtual offsets from Bio.bgzf.'''
+    if is_bgzf:
+        from Bio import bgzf
+        return bgzf.BgzfReader(datafile, 'rb')
+    else:
+        return open(datafile, 'rb')
+
+def file_chunks(datafile, chunk_size=64 * 1024 * 1024, header=1):
+    '''split an uncompressed or BGZF file into chunks of about <chunk_size>
+       bytes, return a list of (start, end) offsets, each aligned to the start
+       of a line, after <header> lines. "end" is None for the last chunk.
+       Return None if the file cannot be split (e.g. a ".gz" file not in BGZF
+       format, or BioPython is not available for a BGZF file).
+    '''
+    if type(datafile) is types.TupleType or datafile.lower().endswith('.zip'):
+        return None
+    is_bgzf = _is_bgzf(datafile)
+    if is_bgzf:
+        try:
+            import Bio.bgzf
+        except ImportError:
+            return None
+        offsets = []
+        next_offset = 0
+        for block_offset in _bgzf_block_offsets(datafile):
+            if block_offset >= next_offset:
+                offsets.append(block_offset << 16)   # virtual offset of the block start
+                next_offset = block_offset + chunk_size
+    elif datafile.lower().endswith('.gz'):
+        return None
+    else:
+        offsets = range(0, os.path.getsize(datafile), chunk_size)
+
+    in_f = _open_chunkable(datafile, is_bgzf)
+    try:
+        for i in range(header):
+            in_f.readline()
+        boundaries = [in_f.tell()]
+        for offset in offsets[1:]:
+            # move to the start of the next line
+            in_f.seek(offset)
+            in_f.readline()
+            pos = in_f.tell()
+            if pos > boundaries[-1]:
+                boundaries.append(pos)
+        if not in_f.readline():
+            # the last boundary is the end of file
+            boundaries.pop()
+    finally:
+        in_f.close()
+    if not boundaries:
+        return []
+    return zip(boundaries, boundaries[1:] + [None])
+
+_chunk_worker_context = {}
+
+def _chunk_rows(datafile, is_bgzf, start, end):
+    '''yield the lines within (start, end) offsets.'''
+    in_f = _open_chunkable(datafile, is_bgzf)
+    try:
+        in_f.seek(start)
+        while end is None or in_f.tell() < end:
+            line = in_f.readline()
+            if not line:
+                break
+            yield line
+    finally:
+        in_f.close()
+
+def _chunk_worker(args):
+    '''parse a chunk of the file into a partial dict.'''
+    start, end = args
+    ctx = _chunk_worker_context
+    includefn = ctx['includefn']
+    cols = ctx['cols']
+    coerce_unicode = ctx['coerce_unicode']
+    rowfn = ctx['rowfn']
+    rows = []
+    for ld in csv.reader(_chunk_rows(ctx['datafile'], ctx['is_bgzf'], start, end), delimiter=ctx['sep']):
+        if not includefn or includefn(ld):
+            if cols is not None:
+                ld = [ld[i] for i in cols]
+            if coerce_unicode:
+                ld = [unicode(x, encoding='utf-8') for x in ld]
+            if rowfn:
+                ld = rowfn(ld)
+                if ld is None:
+                    continue
+            rows.append(ld)
+    return list2dict(rows, ctx['key'], aggregate=ctx['aggregate'])
+
+def reduce_dicts(dict_li, aggregate=None):
+    '''reduce a list of dicts returned by list2dict with the same "aggregate"
+       into one dict. Values of the same key are combined in the list order.
+       A reducer function for "aggregate" is also used to combine two partial
+       values, so it must be associative.
+    '''
+    out = {}
+    for _dict in dict_li:
+        if not out:
+            out = _dict
+            continue
+        for key, value in _dict.iteritems():
+            if key not in out:
+                out[key] = value
+            elif aggregate is None:
+                current_value = out[key]
+                if type(current_value) is not types.ListType:
+                    current_value = [current_value]
+                if type(value) is types.ListType:
+                    current_value.extend(value)
+                else:
+                    current_value.append(value)
+                out[key] = current_value
+            elif aggregate == 'first':
+                pass
+            elif aggregate == 'list':
+                out[key].extend(value)
+            elif aggregate == 'set':
+                out[key].update(value)
+            else:
+                out[key] = aggregate(out[key], value)
+    return out
+
+def tabfile_map_reduce(datafile, rowfn=None, key=0, aggregate=None, alwayslist=False,
+                       header=1, sep='\t', includefn=None, coerce_unicode=True, cols=None,
+                       processes=None, chunk_size=64 * 1024 * 1024, engine='csv'):
+    '''Return a dictionary from rows in a tab-delimited file, parsed in
+       chunks by a pool of processes.
+       Each row is the same as from tabfile_feeder (with header, sep, includefn,
+       coerce_unicode and cols), and then passed to rowfn (if given), which
+       returns a new row (e.g. a (key, value) pair), or None to skip it.
+       Rows are converted into a dictionary by list2dict with key, aggregate
+       and alwayslist.
+       An uncompressed or BGZF file is split into chunks of about <chunk_size>
+       bytes (see file_chunks), parsed by <processes> processes (all CPUs if
+       None), and the partial dicts are reduced in the file order (see
+       reduce_dicts), so the result is the same as a sequential one.
+       rowfn and includefn are inherited by forked processes, so they can be
+       lambdas or closures. Other files (e.g. regular ".gz" files), or
+       processes=1, are parsed sequentially by tabfile_feeder with the given
+       engine (see tabfile_feeder).
+       Note that a quoted field with line breaks is not supported.
+       This is opt-in (processes=1 in tab2dict by default).
+    '''
+    if aggregate is None and alwayslist:
+        aggregate = 'list'
+    chunks = None
+    if processes != 1:
+        chunks = file_chunks(datafile, chunk_size=chunk_size, header=header)
+    if chunks is None or len(chunks) <= 1:
+        rows = tabfile_feeder(datafile, header=header, sep=sep, includefn=includefn,
+                              coerce_unicode=coerce_unicode, cols=cols, engine=engine)
+        if rowfn:
+            rows = (ld for ld in itertools.imap(rowfn, rows) if ld is not None)
+        return list2dict(rows, key, aggregate=aggregate)
+
+    from multiprocessing import Pool
+    _chunk_worker_context.clear()
+    _chunk_worker_context.update({
+        'datafile': datafile,
+        'is_bgzf': _is_bgzf(datafile),
+        'sep': sep,
+        'includefn': includefn,
+        'coerce_unicode': coerce_unicode,
+        'cols': cols,
+        'rowfn': rowfn,
+        'key': key,
+        'aggregate': aggregate
+    })
+    pool = Pool(processes)
+    try:
+        out = reduce_dicts(pool.imap(_chunk_worker, chunks), aggregate=aggregate)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _chunk_worker_context.clear()
+    return out
+
 
 #===============================================================================
 # Dictionary Utility functions
@@ -423,3 +815,193 @@ def dict_to_list(gene_d):
     doc_li = [updated_dict(gene_d[k], {'_id': str(k)}) for k in sorted(gene_d.keys())]
     return doc_li
 
+
+
+#===============================================================================
+# Persistent cache of parsed data files
+#===============================================================================
+# cached parsers registered by parsed_cache decorator: {name: decorated function}
+parsed_cache_registry = {}
+
+def _get_parsed_cache_settings():
+    '''return (cache_folder, max_size) from PARSED_CACHE_FOLDER and
+       PARSED_CACHE_MAX_SIZE in config. Cache is disabled if cache_folder is None.
+    '''
+    import config
+    return (getattr(config, 'PARSED_CACHE_FOLDER', None),
+            getattr(config, 'PARSED_CACHE_MAX_SIZE', 20 * 1024 ** 3))
+
+def file_signature(path):
+    '''return (path, size, mtime) of a file, size and mtime are None if missing.'''
+    path = os.path.abspath(path)
+    if os.path.exists(path):
+        st = os.stat(path)
+        return (path, st.st_size, st.st_mtime)
+    else:
+        return (path, None, None)
+
+def _hash_key(value):
+    import hashlib
+    return hashlib.sha1(repr(value)).hexdigest()[:16]
+
+def _remove_cache_file(path):
+    '''remove a cache file, which could be removed by another process already.'''
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _evict_parsed_cache(cache_folder, max_size, keep=None):
+    '''remove least recently used cache files until the total size is within max_size.'''
+    entries = []
+    for fn in os.listdir(cache_folder):
+        if fn.endswith('.pyobj'):
+            try:
+                st = os.stat(os.path.join(cache_folder, fn))
+            except OSError:
+                continue    # removed by another process
+            entries.append((st.st_mtime, st.st_size, fn))
+    entries.sort()
+    total_size = sum([e[1] for e in entries])
+    for mtime, size, fn in entries:
+        if total_size <= max_size:
+            break
+        if fn != keep:
+            _remove_cache_file(os.path.join(cache_folder, fn))
+            total_size -= size
+
+def _prepare_parsed_cache(cache_folder, prefix, keep):
+    '''create cache_folder if needed, and remove cache files of the same
+       prefix (i.e. name and params) other than keep, which are outdated.
+    '''
+    try:
+        os.makedirs(cache_folder)
+    except OSError:
+        if not os.path.isdir(cache_folder):
+            raise
+    for _fn in os.listdir(cache_folder):
+        if _fn.startswith(prefix) and _fn.endswith('.pyobj') and _fn != keep:
+            _remove_cache_file(os.path.join(cache_folder, _fn))
+
+def _load_parsed_cache_iter(in_f):
+    '''a generator of the items in a cache file saved by parsed_cache with
+       iterator=True, which is a gzip file of pickled lists of items.
+    '''
+    import io
+    import gzip
+    import cPickle as pickle
+    f = io.BufferedReader(gzip.GzipFile(fileobj=in_f, mode='rb'), buffer_size=1024 * 1024)
+    try:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                break
+            for item in batch:
+                yield item
+    finally:
+        f.close()
+        in_f.close()
+
+def parsed_cache(files, params=None, name=None, iterator=False):
+    '''A decorator to cache the output of a parser function on disk, e.g.:
+
+           @parsed_cache(files=lambda self, aslist=False: [self.datafile],
+                         params=lambda self, aslist=False: (self.species_li, aslist))
+           def load(self, aslist=False):
+               ...
+
+       files and params are called with the same arguments as the decorated
+       function. files returns a list of input files, and params returns any
+       parameters affecting the output (must have a stable repr), which are
+       all arguments by default.
+       The cache key is made of name (default is "<module>.<function name>"),
+       params and the path, size and mtime of each input file. Outputs are
+       saved by utils.common.dump into PARSED_CACHE_FOLDER (set in config, no
+       caching if None). When an input file changes, the old cache file for
+       the same name and params is replaced, and least recently used cache
+       files are removed when the total size exceeds PARSED_CACHE_MAX_SIZE.
+       With iterator=True, the function returns an iterator (e.g. load_iter
+       of a parser), whose items are saved in batches while being iterated,
+       and read back in the same way, so that they are never all in memory.
+       The cache file is saved only if the iterator is exhausted.
+       The cache can be shared by concurrent processes: a cache file is written
+       to a per-process temp file and then renamed, and a cache file removed
+       by another process while being loaded is treated as a cache miss.
+    '''
+    if params is None:
+        params = lambda *args, **kwargs: (args, sorted(kwargs.items()))
+
+    def decorator(fn):
+        import functools
+        _name = name or '%s.%s' % (fn.__module__, fn.__name__)
+
+        @functools.wraps(fn)
+        def cached_fn(*args, **kwargs):
+            cache_folder, max_size = _get_parsed_cache_settings()
+            if not cache_folder:
+                return fn(*args, **kwargs)
+            prefix = '%s__%s__' % (_name, _hash_key(params(*args, **kwargs)))
+            cache_fn = prefix + _hash_key([file_signature(f) for f in files(*args, **kwargs)]) + '.pyobj'
+            cache_file = os.path.join(cache_folder, cache_fn)
+            tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+            if os.path.exists(cache_file):
+                print 'Loading from cache "%s"...' % cache_fn,
+                try:
+                    if iterator:
+                        # still readable once opened, even if removed by another process
+                        out = _load_parsed_cache_iter(file(cache_file, 'rb'))
+                    else:
+                        out = loadobj(cache_file)
+                    os.utime(cache_file, None)      # mark as recently used
+                except (OSError, IOError):
+                    # removed (e.g. evicted) by another process
+                    print 'Failed.'
+                else:
+                    print 'Done.'
+                    return out
+
+            out = fn(*args, **kwargs)
+            _prepare_parsed_cache(cache_folder, prefix, keep=cache_fn)
+            if iterator:
+                return _save_iter(out, cache_folder, max_size, cache_fn, tmp_file)
+            dump(out, tmp_file)
+            os.rename(tmp_file, cache_file)
+            _evict_parsed_cache(cache_folder, max_size, keep=cache_fn)
+            return out
+
+        def _save_iter(out, cache_folder, max_size, cache_fn, tmp_file, batch_size=10000):
+            import gzip
+            import cPickle as pickle
+            out_f = gzip.open(tmp_file, 'wb')
+            completed = False
+            try:
+                batch = []
+                for item in out:
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        pickle.dump(batch, out_f, -1)
+                        batch = []
+                    yield item
+                if batch:
+                    pickle.dump(batch, out_f, -1)
+                completed = True
+            finally:
+                out_f.close()
+                if completed:
+                    os.rename(tmp_file, os.path.join(cache_folder, cache_fn))
+                    _evict_parsed_cache(cache_folder, max_size, keep=cache_fn)
+                else:
+                    _remove_cache_file(tmp_file)
+
+        parsed_cache_registry[_name] = cached_fn
+        return cached_fn
+    return decorator
+
+def clear_parsed_cache(name=None):
+    '''remove cache files of a cached parser by name, or all if name is None.'''
+    cache_folder = _get_parsed_cache_settings()[0]
+    if cache_folder and os.path.exists(cache_folder):
+        for fn in os.listdir(cache_folder):
+            if name is None or fn.startswith(name + '__'):
+                _remove_cache_file(os.path.join(cache_folder, fn))
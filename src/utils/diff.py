@@ -3,6 +3,7 @@ Utils to compare two list of gene documents
 '''
 import time
 import os.path
+from array import array
 from utils.common import timesofar
 from databuild.backend import GeneDocMongoDBBackend, GeneDocESBackend
 from utils.mongo import get_target_db
@@ -79,6 +80,99 @@ def _diff_doc_inner_worker(b1, b2, ids, fastdiff=False):
     return _updates
 
 
+class CompactIdList(object):
+    '''An append-only list of ids stored compactly: decimal string ids (e.g.
+       Entrez gene ids) are kept as integers in an array, and only the others
+       (e.g. Ensembl gene ids) in a regular list, along with their positions,
+       so that all ids are still in the order they are appended.
+       Ids are always returned as unicode strings.
+    '''
+    def __init__(self, ids=None):
+        self._int_li = array('l')
+        self._str_li = []
+        self._str_pos = array('l')    # positions of the ids in _str_li
+        for _id in ids or []:
+            self.append(_id)
+
+    @staticmethod
+    def _is_int_id(_id):
+        return isinstance(_id, basestring) and _id.isdigit() and len(_id) < 19 and \
+            (len(_id) == 1 or _id[0] != '0')    # so that it can be converted back as it is
+
+    def append(self, _id):
+        if self._is_int_id(_id):
+            self._int_li.append(int(_id))
+        else:
+            self._str_pos.append(len(self))
+            self._str_li.append(_id)
+
+    def __len__(self):
+        return len(self._int_li) + len(self._str_li)
+
+    def __iter__(self):
+        str_pos = self._str_pos
+        j = 0
+        for i in xrange(len(self)):
+            if j < len(str_pos) and str_pos[j] == i:
+                yield self._str_li[j]
+                j += 1
+            else:
+                yield unicode(self._int_li[i - j])
+
+    def _get_item(self, idx):
+        from bisect import bisect_left
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('CompactIdList index out of range')
+        j = bisect_left(self._str_pos, idx)     # no. of _str_li ids before idx
+        if j < len(self._str_pos) and self._str_pos[j] == idx:
+            return self._str_li[j]
+        return unicode(self._int_li[idx - j])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._get_item(i) for i in xrange(*idx.indices(len(self)))]
+        return self._get_item(idx)
+
+
+def _ascending(id_iter):
+    last_id = None
+    for _id in id_iter:
+        if last_id is not None and _id <= last_id:
+            raise ValueError('ids are not in strictly ascending order ({} <= {}).'.format(_id, last_id))
+        last_id = _id
+        yield _id
+
+
+def diff_sorted_ids(id_iter1, id_iter2):
+    '''compare two id iterators, both in ascending order, with a sorted merge.
+       return three CompactIdList objects of (ids only in 1, ids only in 2, common ids),
+       all in ascending order.
+    '''
+    only_in_1, only_in_2, common = CompactIdList(), CompactIdList(), CompactIdList()
+    _end = object()
+    it1, it2 = _ascending(id_iter1), _ascending(id_iter2)
+    id1, id2 = next(it1, _end), next(it2, _end)
+    while id1 is not _end and id2 is not _end:
+        if id1 == id2:
+            common.append(id1)
+            id1, id2 = next(it1, _end), next(it2, _end)
+        elif id1 < id2:
+            only_in_1.append(id1)
+            id1 = next(it1, _end)
+        else:
+            only_in_2.append(id2)
+            id2 = next(it2, _end)
+    while id1 is not _end:
+        only_in_1.append(id1)
+        id1 = next(it1, _end)
+    while id2 is not _end:
+        only_in_2.append(id2)
+        id2 = next(it2, _end)
+    return only_in_1, only_in_2, common
+
+
 def diff_collections(b1, b2, use_parallel=True, step=10000):
     """
     b1, b2 are one of supported backend class in databuild.backend.
@@ -87,14 +181,9 @@ def diff_collections(b1, b2, use_parallel=True, step=10000):
         b2 = GeneDocMongoDBBackend(c2)
     """
 
-    id_s1 = set(b1.get_id_list())
-    id_s2 = set(b2.get_id_list())
-    print "Size of collection 1:\t", len(id_s1)
-    print "Size of collection 2:\t", len(id_s2)
-
-    id_in_1 = id_s1 - id_s2
-    id_in_2 = id_s2 - id_s1
-    id_common = id_s1 & id_s2
+    id_in_1, id_in_2, id_common = diff_sorted_ids(b1.get_id_iter(), b2.get_id_iter())
+    print "Size of collection 1:\t", len(id_in_1) + len(id_common)
+    print "Size of collection 2:\t", len(id_in_2) + len(id_common)
     print "# of docs found only in collection 1:\t", len(id_in_1)
     print "# of docs found only in collection 2:\t", len(id_in_2)
     print "# of docs found in both collections:\t", len(id_common)
@@ -103,11 +192,10 @@ def diff_collections(b1, b2, use_parallel=True, step=10000):
     _updates = []
     if len(id_common) > 0:
         if not use_parallel:
-            _updates = _diff_doc_inner_worker(b1, b2, list(id_common))
+            _updates = _diff_doc_inner_worker(b1, b2, id_common)
         else:
             from utils.parallel import run_jobs_on_ipythoncluster
             _path = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
-            id_common = list(id_common)
             #b1_target_collection = b1.target_collection.name
             #b2_es_index = b2.target_esidxer.ES_INDEX_NAME
             _b1 = (b1.target_name, b1.name)
@@ -125,13 +213,8 @@ def diff_collections(b1, b2, use_parallel=True, step=10000):
 
         print "Done. [{} docs changed]".format(len(_updates))
 
-    _deletes = []
-    if len(id_in_1) > 0:
-        _deletes = sorted(id_in_1)
-
-    _adds = []
-    if len(id_in_2) > 0:
-        _adds = sorted(id_in_2)
+    _deletes = list(id_in_1)    # already sorted
+    _adds = list(id_in_2)
 
     changes = {'update': _updates,
                'delete': _deletes,
@@ -41,6 +41,151 @@ def lastexception():
     return str(exc_type)+':'+''.join([str(x) for x in excArgs])
 
 
+class ESBulkWriter(object):
+    '''A buffered writer for ES bulk API.
+       index/update/delete actions are accumulated until <max_docs> actions or
+       <max_bytes> bytes, then sent as one bulk request from a background thread,
+       up to <max_inflight> bulk requests at the same time.
+       Actions rejected by ES (e.g. bulk queue is full) are retried with an
+       exponential backoff, starting from <backoff> seconds, up to <max_retries>
+       times. Since add/flush blocks when <max_inflight> requests are pending,
+       the rejections slow down the producer as well.
+       Other failed items reported in bulk responses are collected in self.failures.
+    '''
+    def __init__(self, conn, max_docs=5000, max_bytes=10 * 1024 * 1024, max_inflight=1,
+                 max_retries=10, backoff=1, max_backoff=60):
+        self.conn = conn
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = []     # a list of (op_type, _id, error)
+        self.cnt = 0           # no. of actions sent
+        self.cnt_retried = 0   # no. of actions retried after being rejected
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._pending = []
+        self._pool = None
+
+    def add(self, action, source=None):
+        '''action is a dict like {"index": {"_index": .., "_type": .., "_id": ..}},
+           source is the doc for "index", or {"doc": partial_doc} for "update"
+           and should be None for "delete".
+        '''
+        command = json.dumps(action, cls=self.conn.encoder)
+        if source is not None:
+            command += '\n' + json.dumps(source, cls=self.conn.encoder)
+        self.add_raw(command)
+
+    def add_raw(self, command):
+        '''add one already serialized bulk action (without the trailing newline).'''
+        self._buffer.append(command)
+        self._buffer_bytes += len(command) + 1
+        if len(self._buffer) >= self.max_docs or self._buffer_bytes >= self.max_bytes:
+            self.flush(wait=False)
+
+    def index(self, doc, index_name, index_type, id):
+        self.add({'index': {'_index': index_name, '_type': index_type, '_id': id}}, doc)
+
+    def update(self, id, extra_doc, index_name, index_type):
+        self.add({'update': {'_index': index_name, '_type': index_type, '_id': id}}, {'doc': extra_doc})
+
+    def delete(self, id, index_name, index_type):
+        self.add({'delete': {'_index': index_name, '_type': index_type, '_id': id}})
+
+    @staticmethod
+    def _is_rejected(result):
+        return result.get('status', None) == 429 or \
+            'EsRejectedExecutionException' in str(result.get('error', ''))
+
+    def _send(self, commands):
+        '''send commands as one bulk request, retry rejected ones.
+           return (failures, no. of actions, no. of retried actions).
+        '''
+        n = len(commands)
+        failures = []
+        cnt_retried = 0
+        delay = self.backoff
+        for i in range(self.max_retries + 1):
+            retry = []
+            try:
+                res = self.conn._send_request('POST', '/_bulk', body='\n'.join(commands) + '\n')
+            except ElasticSearchException, e:
+                # the whole request is rejected
+                if getattr(e, 'status', None) != 429 or i == self.max_retries:
+                    raise
+                retry = commands
+            else:
+                for command, item in zip(commands, res.get('items', [])):
+                    op_type, result = item.items()[0]
+                    if result.get('error', None):
+                        if self._is_rejected(result) and i < self.max_retries:
+                            retry.append(command)
+                        else:
+                            failures.append((op_type, result.get('_id', None), result['error']))
+            if not retry:
+                break
+            cnt_retried += len(retry)
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+            commands = retry
+        return failures, n, cnt_retried
+
+    def _collect(self, job):
+        failures, n, cnt_retried = job.get()    # re-raise any error from the bulk request
+        self.cnt += n
+        self.cnt_retried += cnt_retried
+        self.failures.extend(failures)
+
+    def flush(self, wait=True):
+        '''send out buffered actions, if wait is True, also wait for all pending
+           bulk requests to finish.
+        '''
+        if self._buffer:
+            commands = self._buffer
+            self._buffer = []
+            self._buffer_bytes = 0
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.max_inflight)
+            while len(self._pending) >= self.max_inflight:
+                self._collect(self._pending.pop(0))
+            self._pending.append(self._pool.apply_async(self._send, (commands,)))
+        if wait:
+            while self._pending:
+                self._collect(self._pending.pop(0))
+
+    def close(self):
+        self.flush(wait=True)
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def report_failures(self, n=10):
+        '''print out the number of failed items and the first <n> of them.'''
+        if self.cnt_retried:
+            print "{} bulk actions were rejected and retried.".format(self.cnt_retried)
+        if self.failures:
+            print "{} bulk actions failed (out of {}):".format(len(self.failures), self.cnt)
+            for op_type, _id, error in self.failures[:n]:
+                print '\t{}\t{}\t{}'.format(op_type, _id, error)
+            if len(self.failures) > n:
+                print "\t%d lines omitted..." % (len(self.failures) - n)
+
+
+def _serialize_index_batch(args):
+    '''serialize a list of docs into bulk "index" commands, run in a worker process.'''
+    doc_li, index_name, index_type, encoder = args
+    commands = []
+    for doc in doc_li:
+        action = {'index': {'_index': index_name, '_type': index_type, '_id': doc['_id']}}
+        commands.append(json.dumps(action, cls=encoder) + '\n' + json.dumps(doc, cls=encoder))
+    return commands
+
+
 class ESIndexer(object):
     def __init__(self, es_index_name=None, es_index_type=None, mapping=None, es_host=None, step=5000):
         self.conn = get_es(es_host)
@@ -55,8 +200,24 @@ class ESIndexer(object):
         self.number_of_shards = 5      # set number_of_shards when create_index
         self.s = None     # optionally, can specify number of records to skip,
                           # useful to continue indexing after an error.
+        self.start_after_id = None    # optionally, continue indexing after this "_id",
+                                      # much faster than "s" for resuming a large index.
+        self.last_id = None           # "_id" of the last indexed doc, checkpointed after every batch.
+        self.checkpoint_file = None   # if set, self.last_id is also saved into this file.
+        self.prefetch = 2             # no. of batches fetched from mongodb ahead of indexing.
+        self.use_pipeline = False     # index with a pipeline of concurrent serializers and senders.
+        self.num_serializers = 4      # no. of processes serializing docs in pipeline mode.
+        self.num_senders = 4          # no. of concurrent bulk requests in pipeline mode.
         self.use_parallel = False
         self._mapping = mapping
+        self._bulk_writer = None
+
+    @property
+    def bulk_writer(self):
+        '''an ESBulkWriter used by bulk updates, created when first used.'''
+        if self._bulk_writer is None:
+            self._bulk_writer = ESBulkWriter(self.conn, max_docs=self.step)
+        return self._bulk_writer
 
     def check(self):
         '''print out ES server info for verification.'''
@@ -184,16 +345,8 @@ class ESIndexer(object):
             return conn._send_request('POST', path, body=body)
         else:
             # ES supports bulk update since v0.90.1.
-            op_type = 'update'
-            cmd = {op_type: {"_index": index_name,
-                             "_type": index_type,
-                             "_id": id}
-                   }
-
-            doc = json.dumps({"doc": extra_doc}, cls=conn.encoder)
-            command = "%s\n%s" % (json.dumps(cmd, cls=conn.encoder), doc)
-            conn.bulker.add(command)
-            return conn.flush_bulk()
+            # updates are buffered, call self.bulk_writer.flush() to send them all.
+            self.bulk_writer.update(id, extra_doc, index_name, index_type)
 
     def wait_till_all_shards_ready(self, timeout=None, interval=5):
         if timeout:
@@ -244,6 +397,8 @@ class ESIndexer(object):
             print "Building index..."
             if self.use_parallel:
                 cnt = self._build_index_parallel(collection, verbose)
+            elif self.use_pipeline:
+                cnt = self._build_index_pipeline(collection, query=query)
             else:
                 cnt = self._build_index_sequential(collection, verbose, query=query)
         finally:
@@ -295,7 +450,16 @@ class ESIndexer(object):
                 time.sleep(delay)
                 print "done."
 
-        for doc in doc_feeder(collection, step=self.step, s=self.s, batch_callback=rate_control, query=query):
+        def checkpoint(last_id):
+            conn.flush_bulk(forced=True)    # make sure all docs before last_id are sent
+            self.last_id = last_id
+            if self.checkpoint_file:
+                with open(self.checkpoint_file, 'w') as out_f:
+                    json.dump({'last_id': last_id}, out_f)
+
+        for doc in doc_feeder(collection, step=self.step, s=self.s, batch_callback=rate_control, query=query,
+                              start_after_id=self.start_after_id, checkpoint=checkpoint,
+                              prefetch=self.prefetch):
             # ref: http://www.elasticsearch.org/guide/en/elasticsearch/reference/current/docs-index_.html#index-replication
             #querystring_args = {'replication': 'async'}
             querystring_args = None
@@ -306,6 +470,62 @@ class ESIndexer(object):
                 print cnt, ':', doc['_id']
         return cnt
 
+    def _build_index_pipeline(self, collection, query=None):
+        '''index docs from a collection with a pipeline: docs are read by a
+           background thread (doc_feeder with prefetch), serialized by a pool of
+           <self.num_serializers> processes, and sent by <self.num_senders>
+           concurrent bulk requests. Instead of fixed pauses, the pipeline is
+           slowed down by ES bulk rejections (see ESBulkWriter).
+           Note that no checkpoint is saved in this mode, but start_after_id
+           is still respected.
+        '''
+        from multiprocessing import Pool
+        from collections import deque
+
+        index_name = self.ES_INDEX_NAME
+        index_type = self.ES_INDEX_TYPE
+        writer = ESBulkWriter(self.conn, max_docs=self.step, max_inflight=self.num_senders)
+        pool = Pool(self.num_serializers)
+        pending = deque()
+        cnt = 0
+
+        def _add_serialized(job):
+            commands = job.get()
+            for command in commands:
+                writer.add_raw(command)
+            return len(commands)
+
+        try:
+            for doc_li in doc_feeder(collection, step=self.step, inbatch=True, query=query,
+                                     start_after_id=self.start_after_id, prefetch=self.prefetch):
+                pending.append(pool.apply_async(_serialize_index_batch,
+                                                ((doc_li, index_name, index_type, self.conn.encoder),)))
+                # keep the order of batches, and at most 2 batches per serializer in the queue
+                while len(pending) > 2 * self.num_serializers or (pending and pending[0].ready()):
+                    cnt += _add_serialized(pending.popleft())
+            while pending:
+                cnt += _add_serialized(pending.popleft())
+        finally:
+            # also stops the sender threads of the writer if failed
+            try:
+                writer.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        writer.report_failures()
+        return cnt
+
+    def resume_from_checkpoint(self, checkpoint_file=None):
+        '''set start_after_id from the checkpoint file saved by a previous
+           build_index run, so that the next build_index call continues from
+           the last checkpointed doc.
+        '''
+        checkpoint_file = checkpoint_file or self.checkpoint_file
+        with open(checkpoint_file) as in_f:
+            self.start_after_id = json.load(in_f)['last_id']
+        print 'Resuming after _id "{}".'.format(self.start_after_id)
+        return self.start_after_id
+
     def _build_index_parallel(self, collection, verbose=False):
         from utils.parallel import (run_jobs_on_ipythoncluster,
                                     collection_partition,
@@ -327,8 +547,7 @@ class ESIndexer(object):
             port = kwargs['port']
             src_db = kwargs['src_db']
             src_collection = kwargs['src_collection']
-            skip = kwargs['skip']
-            limit = kwargs['limit']
+            query = kwargs['query']
 
             mongo_conn = mongokit.Connection(server, port)
             src = mongo_conn[src_db]
@@ -340,7 +559,7 @@ class ESIndexer(object):
             es_conn = pyes.ES(ES_HOST, default_indices=[ES_INDEX_NAME],
                               timeout=120.0, max_retries=10)
 
-            cur = src[src_collection].find(skip=skip, limit=limit, timeout=False)
+            cur = src[src_collection].find(query, timeout=False)
             cur.batch_size(1000)
             cnt = 0
             try:
@@ -1,11 +1,12 @@
 import time
 from mongokit import Connection
+from pymongo.errors import OperationFailure
 from config import (DATA_SRC_SERVER, DATA_SRC_PORT, DATA_SRC_DATABASE,
                     DATA_SRC_MASTER_COLLECTION, DATA_SRC_DUMP_COLLECTION,
                     DATA_SRC_BUILD_COLLECTION,
                     DATA_TARGET_SERVER, DATA_TARGET_PORT, DATA_TARGET_DATABASE,
                     DATA_TARGET_MASTER_COLLECTION)
-from utils.common import timesofar
+from utils.common import timesofar, prefetch_iter
 
 
 def get_conn(server, port):
@@ -69,23 +70,52 @@ def doc_feeder0(collection, step=1000, s=None, e=None, inbatch=False):
         print 'Done.[%s]' % timesofar(t0)
 
 
-def doc_feeder(collection, step=1000, s=None, e=None, inbatch=False, query=None, batch_callback=None, fields=None):
+def _cursor_batches(cur, step):
+    '''yield docs from a cursor as lists of <step> docs.'''
+    doc_li = []
+    for doc in cur:
+        doc_li.append(doc)
+        if len(doc_li) >= step:
+            yield doc_li
+            doc_li = []
+    if doc_li:
+        yield doc_li
+
+
+def doc_feeder(collection, step=1000, s=None, e=None, inbatch=False, query=None, batch_callback=None, fields=None,
+               start_after_id=None, checkpoint=None, prefetch=0):
     '''A iterator for returning docs in a collection, with batch query.
        additional filter query can be passed via "query", e.g.,
        doc_feeder(collection, query={'taxid': {'$in': [9606, 10090, 10116]}})
        batch_callback is a callback function as fn(cnt, t), called after every batch
        fields is optional parameter passed to find to restrict fields to return.
+
+       If start_after_id or checkpoint is not None, docs are returned in "_id" order
+       (keyset mode), starting after the doc with "_id" of start_after_id if given.
+       checkpoint is a callback function as fn(last_id), called after every batch
+       with the "_id" of the last doc processed. Passing it back as start_after_id
+       resumes from there, without skipping over all docs processed before.
+
+       If prefetch > 0, batches are fetched by a background thread, up to <prefetch>
+       batches ahead of the consumer, so that db I/O overlaps with the processing.
     '''
+    keyset = start_after_id is not None or checkpoint is not None
+    if start_after_id is not None:
+        _range = {'_id': {'$gt': start_after_id}}
+        query = {'$and': [query, _range]} if query else _range
     cur = collection.find(query, timeout=False, fields=fields)
+    if keyset:
+        cur.sort([('_id', 1)])
     n = cur.count()
     s = s or 0
     e = e or n
     print 'Retrieving %d documents from database "%s".' % (n, collection.name)
+    if start_after_id is not None:
+        print 'Starting after _id "%s".' % start_after_id
     t0 = time.time()
-    if inbatch:
-        doc_li = []
     cnt = 0
     t1 = time.time()
+    batches = None
     try:
         if s:
             cur.skip(s)
@@ -94,35 +124,89 @@ def doc_feeder(collection, step=1000, s=None, e=None, inbatch=False, query=None,
         if e:
             cur.limit(e - (s or 0))
         cur.batch_size(step)
+        batches = _cursor_batches(cur, step)
+        if prefetch:
+            batches = prefetch_iter(batches, prefetch)
         print "Processing %d-%d documents..." % (cnt + 1, min(cnt + step, e)),
-        for doc in cur:
+        for doc_li in batches:
+            last_id = doc_li[-1]['_id']     # save it here, docs may be modified by the consumer
             if inbatch:
-                doc_li.append(doc)
+                yield doc_li
             else:
-                yield doc
-            cnt += 1
-            if cnt % step == 0:
-                if inbatch:
-                    yield doc_li
-                    doc_li = []
-                print 'Done.[%.1f%%,%s]' % (cnt * 100. / n, timesofar(t1))
-                if batch_callback:
-                    batch_callback(cnt, time.time()-t1)
-                if cnt < e:
-                    t1 = time.time()
-                    print "Processing %d-%d documents..." % (cnt + 1, min(cnt + step, e)),
-        if inbatch and doc_li:
-            #Important: need to yield the last batch here
-            yield doc_li
+                for doc in doc_li:
+                    yield doc
+            cnt += len(doc_li)
+            print 'Done.[%.1f%%,%s]' % (cnt * 100. / n, timesofar(t1))
+            if batch_callback:
+                batch_callback(cnt, time.time()-t1)
+            if checkpoint:
+                checkpoint(last_id)
+            if cnt < e:
+                t1 = time.time()
+                print "Processing %d-%d documents..." % (cnt + 1, min(cnt + step, e)),
 
-        #print 'Done.[%s]' % timesofar(t1)
-        print 'Done.[%.1f%%,%s]' % (cnt * 100. / n, timesofar(t1))
         print "=" * 20
         print 'Finished.[total time: %s]' % timesofar(t0)
     finally:
+        if batches is not None:
+            batches.close()    # stop the prefetching thread first
         cur.close()
 
 
+def get_id_boundaries(collection, step=100000, query=None, use_splitvector=True):
+    '''return a sorted list of "_id" values, which split the docs in a collection
+       into ranges of about <step> docs each.
+       If use_splitvector is True and no query is passed, try "splitVector" command
+       first, which computes split points from "_id" index on the server side.
+       Otherwise (or "splitVector" is not available, e.g. on mongos), only "_id"
+       field is scanned.
+    '''
+    if use_splitvector and not query:
+        try:
+            res = collection.database.command('splitVector', collection.full_name,
+                                              keyPattern={'_id': 1},
+                                              maxChunkSizeBytes=1024 ** 4,   # let maxChunkObjects decide
+                                              maxChunkObjects=step)
+            return [key['_id'] for key in res['splitKeys']]
+        except OperationFailure:
+            pass
+
+    cur = collection.find(query, fields=[], timeout=False)
+    cur.sort([('_id', 1)])
+    cur.batch_size(max(step, 10000))
+    boundaries = []
+    try:
+        for i, doc in enumerate(cur):
+            if i > 0 and i % step == 0:
+                boundaries.append(doc['_id'])
+    finally:
+        cur.close()
+    return boundaries
+
+
+def id_range_queries(boundaries, query=None):
+    '''return a list of queries for "_id" ranges defined by a sorted list of
+       boundaries (from get_id_boundaries), e.g. [b1, b2] returns
+            [{'_id': {'$lt': b1}},
+             {'_id': {'$gte': b1, '$lt': b2}},
+             {'_id': {'$gte': b2}}]
+       additional filter query can be passed via "query" as well.
+    '''
+    bounds = [None] + list(boundaries) + [None]
+    query_li = []
+    for lower, upper in zip(bounds[:-1], bounds[1:]):
+        _query = dict(query or {})
+        _range = {}
+        if lower is not None:
+            _range['$gte'] = lower
+        if upper is not None:
+            _range['$lt'] = upper
+        if _range:
+            _query['_id'] = _range
+        query_li.append(_query)
+    return query_li
+
+
 def src_clean_archives(keep_last=1, src=None, verbose=True, noconfirm=False):
     '''clean up archive collections in src db, only keep last <kepp_last>
        number of archive.
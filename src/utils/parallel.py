@@ -8,6 +8,7 @@ from IPython.parallel import Client, require
 
 from config import CLUSTER_CLIENT_JSON
 from utils.common import timesofar, ask
+from utils.mongo import get_id_boundaries, id_range_queries
 
 def run_jobs_on_ipythoncluster(worker, task_list, shutdown_ipengines_after_done=False):
 
@@ -43,20 +44,23 @@ def run_jobs_on_ipythoncluster(worker, task_list, shutdown_ipengines_after_done=
     return job.result
 
 def collection_partition(src_collection_list, step=100000):
-    if src_collection_list not in (types.ListType, types.TupleType):
+    '''yield a kwargs dict for each "_id" range of about <step> docs from
+       a collection or a list of collections. kwargs['query'] is a range
+       query like {'_id': {'$gte': a, '$lt': b}}, which can be passed to
+       "find" directly, so that no partition needs to skip over others.
+    '''
+    if type(src_collection_list) not in (types.ListType, types.TupleType):
         src_collection_list = [src_collection_list]
 
-    kwargs = {}
-    kwargs['limit'] = step
     for src_collection in src_collection_list:
-        _kwargs = copy.copy(kwargs)
+        _kwargs = {}
         _kwargs['src_collection'] = src_collection.name
         _kwargs['src_db'] = src_collection.database.name
         _kwargs['server'] = src_collection.database.connection.host
         _kwargs['port'] = src_collection.database.connection.port
 
-        cnt = src_collection.count()
-        for s in range(0, cnt, step):
+        boundaries = get_id_boundaries(src_collection, step=step)
+        for query in id_range_queries(boundaries):
             __kwargs = copy.copy(_kwargs)
-            __kwargs['skip'] = s
+            __kwargs['query'] = query
             yield __kwargs